@@ -1,10 +1,23 @@
 #!/usr/bin/env python
 import os, sys, argparse, configparser, datetime, getpass, json, shutil, glob, shlex
-import socket, subprocess, tempfile, time, importlib
+import socket, subprocess, tempfile, time, importlib, pickle, struct, secrets
+import ctypes, ctypes.util, fnmatch, select, hashlib, stat, fcntl, sqlite3
+import resource, signal, re, threading, atexit, warnings, weakref
 
-DATA_DIR = os.environ['MEMO']
+DATA_DIR = os.environ.get('MEMO', '')  # checked when run as a script, not to log results
 CONFIG = configparser.ConfigParser()
 CONFIG.read(os.path.expanduser('~/.memo'))
+CACHE_PATH = os.path.expanduser('~/.cache/memo.json')
+CACHE_MAX_AGE = 24 * 60 * 60  # seconds
+# ssh connections are shared through a control socket per user, host and port
+SSH_CONTROL_PATH = os.path.join(tempfile.gettempdir(),
+                                f'memo-ssh-{getpass.getuser()}', '%C')
+SSH_PERSIST = 600  # seconds an idle shared connection is kept open
+SOURCE_STORE = os.path.join(DATA_DIR, '.objects')  # content-addressed source files
+# run folders are made next to the store, so that snapshots can link to it
+RUNS_PATH = os.path.join(DATA_DIR, '.runs')
+FICLONE = 0x40049409  # ioctl making a copy-on-write clone of a file (Linux)
+STORE_GRACE = 3600  # seconds new source objects are safe from `memo gc`
 
 """
 Config structure:
@@ -22,20 +35,75 @@ qos = dicarlo
 
 [vsc]
 user = ...
+
+[sync]
+interval = 5
+exclude = *.tmp, checkpoints/old
+append = log.out, log.err, results*.stream
+latest = checkpoints/*.pt
+compress = true
+bwlimit = 10m
+
+[source]
+exclude = data, *.ckpt
+link = true
+copy = configs/*.yaml
+
+[queue]
+max_jobs = 4
+gpus = 0,1,2,3
+
+The [sync] section is optional: `interval` is how many seconds changes are
+collected before being pushed to db and `exclude` lists rsync-style patterns
+that are never synced. Files matching `append` only grow, so only their new
+part is sent, and of the files matching a `latest` pattern only the newest
+one is sent. Transfers are compressed (`compress`, except to localhost) and
+capped at `bwlimit` (rsync units, unlimited by default).
+
+The [source] section is optional too: `exclude` lists patterns that are left
+out of source snapshots on top of what .gitignore already excludes, and `link`
+can be set to false to always copy snapshot files rather than link them.
+`copy` lists patterns of files that are always copied, for files that runs
+edit in place: hardlinked files are shared with the store and other runs.
+
+The [queue] section is optional as well and applies to the machine the queue
+worker runs on: `max_jobs` is how many runs may run at once and `gpus` lists
+the GPUs handed out to runs (see get_queue_config for the defaults).
 """
 
 
+_HOST_PROPERTIES = None
+
+
 def get_host_properties():
     """
     Get host, cluster name and node using IP addres
 
+    The result is cached per machine (the cache file may be shared over
+    several machines through the home folder) for CACHE_MAX_AGE.
+
     From: https://stackoverflow.com/a/166589
     """
+    global _HOST_PROPERTIES
+    if _HOST_PROPERTIES is None:
+        key = f'host {os.uname().nodename}'
+        _HOST_PROPERTIES = read_cache(key)
+        if _HOST_PROPERTIES is None:
+            _HOST_PROPERTIES = _detect_host()
+            write_cache(key, _HOST_PROPERTIES)
+    return tuple(_HOST_PROPERTIES)
+
+
+def _detect_host():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.connect(("8.8.8.8", 80))
-    ip = s.getsockname()[0]
+    try:
+        s.connect(("8.8.8.8", 80))  # nothing is sent, this only picks a route
+        ip = s.getsockname()[0]
+    except OSError:  # offline
+        ip = None
+    finally:
+        s.close()
     host, cluster = IPS.get(ip, ('localhost', os.uname().nodename))
-    s.close()
     if cluster == 'braintree':
         if 'gpu' in host:
             node_id = host.split(".")[0].split("-")[-1]
@@ -47,30 +115,473 @@ def get_host_properties():
     return host, cluster, node
 
 
-def get_local_output(command):
-    output = subprocess.run(command, shell=True, check=True,
-                          stdout=subprocess.PIPE).stdout
-    output = output.decode().strip('\n')
-    return output
+# Results can be stored as append-only streams of length-prefixed pickles,
+# possibly split over several segments matching this pattern
+RESULTS_PATTERN = 'results*.stream'
+RECORD_HEADER = struct.Struct('>Q')
+PICKLE_PROTOCOL = 4  # readable by any Python 3.4+ server
+
+
+def append_records(path, records):
+    """
+    Append records to a results stream
+    """
+    with open(path, 'ab') as f:
+        for rec in records:
+            data = pickle.dumps(rec, protocol=PICKLE_PROTOCOL)
+            f.write(RECORD_HEADER.pack(len(data)) + data)
+
+
+def read_records(path, offset=0):
+    """
+    Read records from a results stream starting at a byte offset
+
+    Returns the records and the offset right after the last complete record,
+    so that a record that is still being written is picked up on the next call.
+    """
+    records = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            size, = RECORD_HEADER.unpack(header)
+            data = f.read(size)
+            if len(data) < size:
+                break
+            records.append(pickle.loads(data))
+            offset += RECORD_HEADER.size + size
+    return records, offset
+
+
+FLUSH_INTERVAL = 5  # seconds logged records may wait before being written
+FLUSH_RECORDS = 1000  # or until this many are waiting
+SEGMENT_BYTES = 64 * 1024 ** 2  # results segments are rotated at this size
 
 
-def exec_remote(command, user, host, wait=True):
+class ResultsLogger(object):
+    """
+    Logs result records of a run from within the running script
+
+    Records are pickled right away and written by a background thread in
+    batches, every FLUSH_INTERVAL seconds or FLUSH_RECORDS records, each
+    batch with a single append. Each logger writes its own results
+    segments (`results.000000.stream`, ...) in the run folder (MEMO_DIR, as
+    exported by run.sh), starting a new one once `segment_bytes` are
+    written, so that files synced while the run goes stay small. A segment
+    is claimed by creating it exclusively, so several processes of one run
+    can log side by side. Records look like the ones the server plots, e.g.
+    `{'meta': {'step': 10}, 'train': {'loss': .5, 'acc': .8}}`.
+
+    Without a folder, i.e. outside of a memo run, records are dropped with a
+    warning. A forked child continues with a new segment of its own.
+    """
+
+    def __init__(self, memo_dir=None, flush_interval=FLUSH_INTERVAL,
+                 segment_bytes=SEGMENT_BYTES):
+        if memo_dir is None:
+            memo_dir = os.environ.get('MEMO_DIR')
+            if memo_dir is None:
+                warnings.warn('MEMO_DIR is not set, results are not logged')
+        self.memo_dir = memo_dir
+        self.flush_interval = flush_interval
+        self.segment_bytes = segment_bytes
+        self.buffer = []  # encoded records waiting to be written
+        self.cond = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.fd = None
+        self.segment = -1
+        self.size = 0
+        self.error = None
+        self.closed = False
+        self.thread = None
+        if memo_dir is not None:
+            self._start()
+            atexit.register(self.close)
+            _LOGGERS.add(self)
+
+    def log(self, record):
+        """
+        Queue a record for writing
+        """
+        if not isinstance(record, dict) or not isinstance(record.get('meta'), dict):
+            raise ValueError("Records need a 'meta' dict, e.g. {'meta': {'step': 0}}")
+        if self.memo_dir is None:
+            return
+        self._check()
+        data = pickle.dumps(record, protocol=PICKLE_PROTOCOL)
+        with self.cond:
+            if self.closed:
+                raise ValueError('Logging to a closed ResultsLogger')
+            self.buffer.append(RECORD_HEADER.pack(len(data)) + data)
+            if len(self.buffer) >= FLUSH_RECORDS:
+                self.cond.notify()
+
+    def flush(self):
+        """
+        Write all queued records now
+        """
+        self._flush()
+        self._check()
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _check(self):
+        # errors of the background thread surface in the logging script
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _after_fork(self):
+        # the parent still writes what was queued before the fork, so the
+        # child drops its copy, leaves the parent's segment alone and gets
+        # fresh locks and a thread of its own
+        self.buffer = []
+        self.cond = threading.Condition()
+        self.write_lock = threading.Lock()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.error = None
+        if not self.closed:
+            self._start()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if not self.closed and len(self.buffer) < FLUSH_RECORDS:
+                    self.cond.wait(self.flush_interval)
+                if self.closed:
+                    return
+            try:
+                self._flush()
+            except Exception as err:
+                self.error = err
+
+    def _flush(self):
+        with self.write_lock:
+            with self.cond:
+                batch, self.buffer = self.buffer, []
+            if not batch:
+                return
+            try:
+                self._write(b''.join(batch))
+            except Exception:  # keep the records for the next try
+                with self.cond:
+                    self.buffer[:0] = batch
+                raise
+
+    def _write(self, data):
+        if self.fd is None or self.size >= self.segment_bytes:
+            self._rotate()
+        offset = 0
+        try:
+            while offset < len(data):
+                offset += os.write(self.fd, data[offset:])
+        except OSError:
+            if offset > 0:  # readers stop at the cut record, so move on
+                self.size = self.segment_bytes
+            raise
+        self.size += len(data)
+
+    def _rotate(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        while True:
+            self.segment += 1
+            path = os.path.join(self.memo_dir, f'results.{self.segment:06d}.stream')
+            try:
+                self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL)
+            except FileExistsError:  # taken by an earlier run or another process
+                continue
+            self.size = 0
+            return
+
+
+_LOGGER = None
+_LOGGERS = weakref.WeakSet()  # open loggers, restarted in forked children
+
+
+def _restart_loggers():
+    for logger in list(_LOGGERS):
+        logger._after_fork()
+
+
+os.register_at_fork(after_in_child=_restart_loggers)
+
+
+def log(record):
+    """
+    Log a result record of the current run, see ResultsLogger
+    """
+    global _LOGGER
+    if _LOGGER is None:
+        _LOGGER = ResultsLogger()
+    _LOGGER.log(record)
+
+
+# meta.json belongs to the run (written at launch and by on_exit) while edits
+# made on the db side, e.g. in the browser, are appended to a separate log that
+# syncing never touches, so neither can overwrite the other
+EDITS_FILE = 'edits.jsonl'
+SYNC_EXCLUDE = [EDITS_FILE, '.*.tmp']  # never sent from compute nodes
+# files that only grow are synced by appending what is new
+SYNC_APPEND = 'log.out, log.err, results*.stream'
+RSYNC_PARTIAL_DIR = '.rsync-partial'  # interrupted transfers are kept here
+
+
+def write_meta(run_dir, rec):
+    """
+    Atomically replace the meta.json of a run
+    """
+    path = os.path.join(run_dir, 'meta.json')
+    tmp_path = os.path.join(run_dir, f'.meta.json.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(rec, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def append_edit(run_dir, key, value):
+    """
+    Record a change of a meta.json field in the edit log of a run
+
+    Each edit is a single locked append, so concurrent edits are all kept.
+    """
+    line = json.dumps({'time': time.time(), 'key': key, 'value': value}) + '\n'
+    with open(os.path.join(run_dir, EDITS_FILE), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(line)
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_meta(run_dir):
+    """
+    Read the meta.json of a run with the edits from its log applied in order
+    """
+    with open(os.path.join(run_dir, 'meta.json')) as f:
+        rec = json.load(f)
+    try:
+        with open(os.path.join(run_dir, EDITS_FILE)) as f:
+            lines = f.readlines()
+    except OSError:
+        lines = []
+    for line in lines:
+        try:
+            edit = json.loads(line)
+        except ValueError:  # a line that is still being written
+            continue
+        rec[edit['key']] = edit['value']
+    return rec
+
+
+_LAST_MEMO_ID = ''
+
+
+def new_memo_id():
+    """
+    Generate a unique memo_id that sorts by creation time
+
+    Looks like 20190131_235959_123_0123456789abcdef: the time down to the
+    millisecond followed by 64 random bits, so that runs launched at the
+    same time from different processes or hosts do not collide. Ids
+    generated within a process are strictly increasing.
+    """
+    global _LAST_MEMO_ID
+    while True:
+        now = datetime.datetime.now()
+        memo_id = (now.strftime('%Y%m%d_%H%M%S') +
+                   f'_{now.microsecond // 1000:03d}_{secrets.token_hex(8)}')
+        if memo_id > _LAST_MEMO_ID:
+            _LAST_MEMO_ID = memo_id
+            return memo_id
+        time.sleep(.001)
+
+
+def get_git_info(path='.'):
+    """
+    Get the top folder, commit and GitHub url of the git repository at path
+
+    Returns (None, None, None) outside of a repository. Only one git process
+    is started; the remote url is read from the repository config directly.
+    """
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--show-toplevel',
+                              '--git-common-dir', 'HEAD'],
+                             cwd=path, stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL).stdout
+    except OSError:  # no git at all
+        return None, None, None
+    lines = out.decode().splitlines()
+    if len(lines) < 2:  # not a repository
+        return None, None, None
+    toplevel, git_dir = lines[:2]
+    commit = lines[2] if len(lines) > 2 else None
+    if commit == 'HEAD':  # rev-parse echoes HEAD before the first commit
+        commit = None
+
+    config = configparser.ConfigParser(strict=False, interpolation=None)
+    try:
+        config.read(os.path.join(path, git_dir, 'config'))
+        remote_url = config.get('remote "origin"', 'url', fallback='')
+    except configparser.Error:
+        remote_url = ''
+    if 'github.com' in remote_url:
+        if remote_url.startswith('git@github.com'):
+            repo = remote_url.split(":")[1][:-4]  # strip .git
+            remote_url = f'https://github.com/{repo}'
+    else:
+        remote_url = None
+    return toplevel, commit, remote_url
+
+
+class PhaseTimer(object):
+    """
+    Measures how long each phase of a launch takes
+    """
+
+    def __init__(self):
+        self.phases = []
+        self.last = time.perf_counter()
+
+    def done(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        total = sum(t for _, t in self.phases)
+        print('Timings:', ', '.join(f'{phase} {t * 1000:.0f} ms' for phase, t in self.phases),
+              f'(total {total * 1000:.0f} ms)')
+
+
+def read_cache(key, max_age=CACHE_MAX_AGE):
+    """
+    Get a value stored with `write_cache` unless it is older than `max_age`
+    """
+    try:
+        with open(CACHE_PATH) as f:
+            entry = json.load(f)[key]
+    except (OSError, ValueError, KeyError):
+        return None
+    if time.time() - entry['time'] > max_age:
+        return None
+    return entry['value']
+
+
+def write_cache(key, value):
+    """
+    Store a value in the per-user cache file shared by all memo processes
+    """
+    try:
+        with open(CACHE_PATH) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cache[key] = {'time': time.time(), 'value': value}
+    os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(CACHE_PATH))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, CACHE_PATH)
+
+
+def ssh_command(user, host):
+    """
+    Get an ssh command that reuses a persistent connection to the host
+
+    Unless one is running already, a control master is started in the
+    background and kept open for SSH_PERSIST seconds after its last use, so
+    that later calls from this and other memo processes (including rsync)
+    skip the connection handshake. The check runs on every call, so an
+    expired master is started again. If the master cannot be started, ssh
+    simply connects as usual.
+    """
+    os.makedirs(os.path.dirname(SSH_CONTROL_PATH), mode=0o700, exist_ok=True)
+    command = ['ssh', '-o', f'ControlPath={SSH_CONTROL_PATH}']
+    login = f'{user}@{host}'
+    check = subprocess.run(command + ['-O', 'check', login],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if check.returncode != 0:
+        # the master must not hold on to our pipes, hence all the DEVNULLs
+        subprocess.run(command + ['-o', f'ControlPersist={SSH_PERSIST}',
+                                  '-fNM', login],
+                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+    return command
+
+
+def rsync_command(user, host):
+    """
+    Get an rsync command whose transfers to the host go over the shared ssh connection
+
+    Transfers are compressed unless the host is this machine or `compress` is
+    false in the [sync] section of the config, limited to `bwlimit` (as
+    understood by rsync --bwlimit, e.g. 10m) if given, and files cut off by
+    an interrupted transfer are resumed from a partial dir next time.
+    """
+    command = ['rsync', '-aq', '-e', ' '.join(ssh_command(user, host)),
+               f'--partial-dir={RSYNC_PARTIAL_DIR}']
+    if CONFIG.getboolean('sync', 'compress', fallback=host not in ['localhost', '127.0.0.1']):
+        command.append('-z')
+    bwlimit = CONFIG.get('sync', 'bwlimit', fallback='')
+    if bwlimit:
+        command.append(f'--bwlimit={bwlimit}')
+    return command
+
+
+def exec_remote(command, user, host, wait=True, check=False):
     """
     Execute a command on a remote server and return stdout output
+
+    With `check`, raises CalledProcessError if ssh or the command fails.
     """
     bash_command = f"bash --login -c '{command}'"
-    out = subprocess.run(['ssh', f'{user}@{host}', bash_command],
+    out = subprocess.run(ssh_command(user, host) + [f'{user}@{host}', bash_command],
                           stderr=subprocess.STDOUT,
-                          stdout=subprocess.PIPE)
+                          stdout=subprocess.PIPE, check=check)
     return out.stdout.decode('ascii')
             
 
 def get_remote_env_var(varname, user, host):
     """
     Get an environment variable from a remote server
+
+    Values are cached for CACHE_MAX_AGE, so repeated lookups (e.g. of the db
+    $MEMO when syncing) do not open a new connection each time.
     """
-    out = exec_remote(f'echo ${varname}', user, host)
-    var = out.split('\n')[-2] 
+    key = f'env {user}@{host} {varname}'
+    var = read_cache(key)
+    if var is None:
+        out = exec_remote(f'echo ${varname}', user, host, check=True)
+        var = out.split('\n')[-2] 
+        if var:
+            write_cache(key, var)
     return var
 
 
@@ -79,62 +590,874 @@ def get_memo_id(local_memo_dir):
     return rec['memo_id']
 
 
-def watch_and_sync(local_memo_dir, sleep=5):
+def get_source_parent(local_memo_dir):
+    """
+    Get the memo_id of the previous run launched from the same source tree
+    """
+    rec = json.load(open(os.path.join(local_memo_dir, 'meta.json'), 'r'))
+    return rec.get('source parent')
+
+
+def get_patterns(option, fallback=''):
+    patterns = CONFIG.get('sync', option, fallback=fallback)
+    return [p.strip() for p in patterns.split(',') if p.strip()]
+
+
+def get_sync_config():
+    """
+    Get sync interval and exclude patterns from the [sync] section of the config
+    """
+    interval = CONFIG.getfloat('sync', 'interval', fallback=5)
+    return interval, get_patterns('exclude')
+
+
+def get_sync_rules():
+    """
+    Get patterns of files that only grow and of files of which only the latest counts
+
+    Both come from the [sync] section of the config, as `append` (logs and
+    results streams by default) and `latest` (none by default).
+    """
+    return get_patterns('append', SYNC_APPEND), get_patterns('latest')
+
+
+def older_than_latest(src, latest):
+    """
+    Find files matching a `latest` pattern that are not the newest match, relative to src
+
+    Only the folders a pattern can match in are walked, e.g. `checkpoints`
+    for `checkpoints/*.pt`; patterns without a slash match at any level.
+    """
+    newest = {}  # pattern -> (mtime, relpath)
+    older = []
+    for top in latest_folders(latest):
+        for root, _, files in os.walk(os.path.join(src, top)):
+            for name in files:
+                relpath = os.path.relpath(os.path.join(root, name), src)
+                for pattern in latest:
+                    if is_excluded(relpath, [pattern]):
+                        try:
+                            entry = (os.path.getmtime(os.path.join(root, name)), relpath)
+                        except OSError:  # removed in the meantime
+                            break
+                        if pattern in newest:
+                            older.append(min(newest[pattern], entry)[1])
+                            entry = max(newest[pattern], entry)
+                        newest[pattern] = entry
+                        break
+    return older
+
+
+def latest_folders(latest):
+    """
+    Get the folders, relative to the memo dir, that hold all matches of the patterns
+    """
+    folders = set()
+    for pattern in latest:
+        parts = pattern.strip('/').split('/')
+        if len(parts) == 1:  # a name at any level
+            return ['']
+        fixed = []
+        for part in parts[:-1]:
+            if any(c in part for c in '*?['):
+                break
+            fixed.append(part)
+        folders.add(os.path.join(*fixed) if fixed else '')
+    # walk each folder once, not again as part of an enclosing one
+    return [f for f in sorted(folders)
+            if not any(f != g and (g == '' or f.startswith(g + os.path.sep))
+                       for g in folders)]
+
+
+def is_excluded(relpath, exclude):
+    """
+    Check if a path relative to the memo dir matches any exclude pattern
+
+    Like rsync, patterns without a slash match the file or folder name at any
+    level, and a matching folder excludes everything below it.
+    """
+    parts = relpath.split(os.path.sep)
+    for pattern in exclude:
+        pattern = pattern.rstrip('/')
+        if '/' in pattern:
+            if any(fnmatch.fnmatch(os.path.sep.join(parts[:i]), pattern)
+                   for i in range(1, len(parts) + 1)):
+                return True
+        elif any(fnmatch.fnmatch(part, pattern) for part in parts):
+            return True
+    return False
+
+
+class PollWatcher(object):
+    """
+    Detects changed files by comparing modification times between walks
+    """
+
+    def __init__(self, path, exclude=()):
+        self.path = path
+        self.exclude = exclude
+        self.mtimes = self.scan()
+
+    def scan(self):
+        mtimes = {}
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            rel = os.path.relpath(dirpath, self.path)
+            rel = '' if rel == '.' else rel
+            dirnames[:] = [d for d in dirnames
+                           if not is_excluded(os.path.join(rel, d), self.exclude)]
+            for filename in filenames:
+                relpath = os.path.join(rel, filename)
+                if not is_excluded(relpath, self.exclude):
+                    try:
+                        mtimes[relpath] = os.path.getmtime(os.path.join(dirpath, filename))
+                    except OSError:  # removed in the meantime
+                        pass
+        return mtimes
+
+    def wait(self, interval):
+        """
+        Sleep for `interval` and return the paths that changed meanwhile
+        """
+        time.sleep(interval)
+        mtimes = self.scan()
+        changed = set(p for p, t in mtimes.items() if self.mtimes.get(p) != t)
+        self.mtimes = mtimes
+        return changed
+
+
+class InotifyWatcher(object):
+    """
+    Detects changed files with Linux inotify, so an idle folder costs nothing
+
+    Raises OSError if inotify is not available.
+    """
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, path, exclude=()):
+        self.path = path
+        self.exclude = exclude
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {}  # watch descriptor -> folder relative to path
+        self.add_tree('')
+
+    def add_tree(self, rel):
+        """
+        Watch a folder and its subfolders, returning the files found in them
+        """
+        files = set()
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.path, rel)):
+            drel = os.path.relpath(dirpath, self.path)
+            drel = '' if drel == '.' else drel
+            dirnames[:] = [d for d in dirnames
+                           if not is_excluded(os.path.join(drel, d), self.exclude)]
+            wd = self.libc.inotify_add_watch(self.fd, dirpath.encode(), self.MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f'Cannot watch {dirpath}')
+            self.dirs[wd] = drel
+            files.update(os.path.join(drel, f) for f in filenames
+                         if not is_excluded(os.path.join(drel, f), self.exclude))
+        return files
+
+    def read(self, changed):
+        """
+        Read pending events into `changed`; returns False on queue overflow
+        """
+        buf = os.read(self.fd, 64 * 1024)
+        i = 0
+        while i < len(buf):
+            wd, mask, cookie, size = self.EVENT.unpack_from(buf, i)
+            name = buf[i + self.EVENT.size:i + self.EVENT.size + size].rstrip(b'\0').decode()
+            i += self.EVENT.size + size
+            if mask & self.IN_Q_OVERFLOW:
+                return False
+            if wd not in self.dirs or not name:
+                continue
+            relpath = os.path.join(self.dirs[wd], name)
+            if is_excluded(relpath, self.exclude):
+                continue
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    changed.update(self.add_tree(relpath))
+            else:
+                changed.add(relpath)
+        return True
+
+    def wait(self, interval):
+        """
+        Block until something changes, then collect changes for `interval`
+
+        Returns the changed paths or None if events were lost and
+        everything should be synced.
+        """
+        changed = set()
+        select.select([self.fd], [], [])
+        deadline = time.time() + interval
+        while True:
+            if not self.read(changed):
+                self.add_tree('')
+                return None
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([self.fd], [], [], remaining)[0]:
+                return changed
+
+
+def watch_and_sync(local_memo_dir, sleep=None):
     """
-    Watches a folder and syncs it to db
+    Watches a folder and syncs changed files to db
+
+    Changes are collected for `sleep` seconds (the [sync] interval from the
+    config by default) and only the changed files are pushed, in one rsync.
+    Uses inotify when available and falls back to polling.
     """
+    interval, exclude = get_sync_config()
+    if sleep is not None:
+        interval = sleep
     db_memo = get_remote_env_var('MEMO', CONFIG['db']['user'], CONFIG['db']['host'])
     memo_id = get_memo_id(local_memo_dir)
     db_memo_dir = os.path.join(db_memo, memo_id)
-    last_update = 0
+    try:
+        watcher = InotifyWatcher(local_memo_dir, exclude=exclude)
+    except OSError as err:
+        print(f'Falling back to polling ({err})')
+        watcher = PollWatcher(local_memo_dir, exclude=exclude)
+    sync(local_memo_dir, db_memo_dir, exclude=exclude,
+         link_dest=get_source_parent(local_memo_dir))
     while True:
-        time.sleep(5)
-        done = False
-        for dirpath, dirnames, filenames in os.walk(local_memo_dir):
-            for filename in filenames:
-                this_update = os.path.getmtime(os.path.join(dirpath, filename))
-                if this_update > last_update:
-                    last_update = this_update
-                    sync(local_memo_dir, db_memo_dir)
-                    done = True
-                    break
-            if done:
-                break
+        changed = watcher.wait(interval)
+        if changed is None:
+            sync(local_memo_dir, db_memo_dir, exclude=exclude)
+        elif len(changed) > 0:
+            sync(local_memo_dir, db_memo_dir, paths=changed, exclude=exclude)
 
 
-def sync(src, dst):
+def sync(src, dst, paths=None, exclude=(), link_dest=None):
     """
     Sync local source folder to a remote destination
+
+    If `paths` (relative to `src`) are given, only these files are sent.
+    Files identical to those in a `link_dest` folder next to `dst` (e.g., the
+    previous run's source snapshot) are hardlinked instead of stored again.
+
+    Files matching the `append` rules are sent in a second rsync that only
+    appends their new part (and checks the old one), and of the files matching
+    a `latest` rule only the newest is sent (see get_sync_rules).
+    """
+    append, latest = get_sync_rules()
+    if paths is not None:  # only rules that a changed file falls under
+        latest = [l for l in latest if any(is_excluded(path, [l]) for path in paths)]
+    older = older_than_latest(src, latest)
+    exclude = SYNC_EXCLUDE + list(exclude) + [f'/{path}' for path in older]
+    if paths is not None:
+        older = set(older)
+        paths = [path for path in paths if path not in older]
+        grown = [path for path in paths if is_excluded(path, append)]
+        paths = [path for path in paths if not is_excluded(path, append)]
+        if len(paths) > 0:
+            _rsync(src, dst, exclude + append, paths=paths, link_dest=link_dest)
+        if len(grown) > 0:
+            _rsync(src, dst, exclude, paths=grown, options=['--append-verify'])
+    else:
+        _rsync(src, dst, exclude + append, link_dest=link_dest)
+        if len(append) > 0:
+            _rsync(src, dst, exclude, options=['--append-verify', '-m', '--include=*/'] +
+                   [f'--include={a}' for a in append] + ['--exclude=*'])
+
+
+def _rsync(src, dst, exclude, paths=None, link_dest=None, options=()):
+    command = rsync_command(CONFIG['db']['user'], CONFIG['db']['host'])
+    command += [f'--exclude={e}' for e in exclude]
+    command += list(options)
+    if link_dest is not None:
+        command.append(f'--link-dest=../{link_dest}')
+    if paths is not None:
+        command.append('--files-from=-')
+    command += [f'{src}/', f"{CONFIG['db']['user']}@{CONFIG['db']['host']}:{dst}"]
+    p = subprocess.Popen(command, stdin=subprocess.PIPE if paths is not None else None)
+    p.communicate(None if paths is None else '\n'.join(sorted(paths)).encode())
+
+
+def list_source_files(path):
+    """
+    List files to snapshot, relative to path
+
+    In git repositories these are tracked files and untracked files that are
+    not ignored, otherwise all files. Files matching the [source] exclude
+    patterns are always skipped.
     """
-    subprocess.Popen(['rsync', '-aq', f'{src}/',
-                      f"{CONFIG['db']['user']}@{CONFIG['db']['host']}:{dst}"]).wait()
+    try:
+        out = subprocess.run(['git', 'ls-files', '-z', '--cached', '--others',
+                              '--exclude-standard'],
+                             cwd=path, stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, check=True).stdout
+        files = [f for f in out.decode().split('\0') if f]
+    except (OSError, subprocess.CalledProcessError):  # not a git repository
+        files = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            rel = os.path.relpath(dirpath, path)
+            files += [os.path.normpath(os.path.join(rel, f)) for f in filenames]
+    exclude = CONFIG.get('source', 'exclude', fallback='')
+    exclude = [e.strip() for e in exclude.split(',') if e.strip()]
+    # deleted but tracked files and submodules are not regular files
+    return [f for f in files if not is_excluded(f, exclude)
+            and os.path.isfile(os.path.join(path, f))]
+
+
+class SourceStore(object):
+    """
+    Content-addressed store of source files shared by all runs
+
+    Every unique file is stored once, read-only, under its sha1. Source
+    snapshots are made of copy-on-write clones of these objects where the file
+    system supports it (btrfs, xfs), so that each run can edit its own files,
+    otherwise of copies. With `link = true` in the [source] config they are
+    hardlinks instead, which share the read-only objects between runs, except
+    for files matching the `copy` patterns. Hashes are cached by path, size
+    and mtime, so snapshotting an unchanged repository reads no file contents.
+    """
+
+    def __init__(self, path=SOURCE_STORE, link=None):
+        self.path = path
+        self.link = CONFIG.getboolean('source', 'link', fallback=False) if link is None else link
+        copy = CONFIG.get('source', 'copy', fallback='')
+        self.copy = [c.strip() for c in copy.split(',') if c.strip()]
+        self.can_clone = True  # until a clone fails
+        self.stat_cache_path = os.path.join(path, 'stat_cache.json')
+        try:
+            with open(self.stat_cache_path) as f:
+                self.stat_cache = json.load(f)
+        except (OSError, ValueError):
+            self.stat_cache = {}
+
+    def object_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def add(self, path):
+        """
+        Store a file unless its content is already there and return its hash
+        """
+        st = os.stat(path)
+        key = os.path.abspath(path)
+        cached = self.stat_cache.get(key)
+        if cached is not None and cached[:2] == [st.st_size, st.st_mtime_ns]:
+            digest = cached[2]
+        else:
+            sha1 = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 ** 2), b''):
+                    sha1.update(chunk)
+            digest = sha1.hexdigest()
+            self.stat_cache[key] = [st.st_size, st.st_mtime_ns, digest]
+
+        obj = self.object_path(digest)
+        if not os.path.isfile(obj):
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(obj))
+            os.close(fd)
+            shutil.copy2(path, tmp_path)
+            # objects are shared between runs, so they must never change
+            os.chmod(tmp_path, stat.S_IMODE(st.st_mode) & ~0o222)
+            os.replace(tmp_path, obj)
+        return digest
+
+    def place(self, obj, target, link=False):
+        """
+        Put a stored object at target as a clone, else a hardlink or writable copy
+        """
+        if self.can_clone:
+            try:
+                with open(obj, 'rb') as fsrc, open(target, 'wb') as fdst:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except OSError:  # no copy-on-write here, so no use trying again
+                self.can_clone = False
+                if os.path.exists(target):
+                    os.remove(target)
+            else:
+                shutil.copystat(obj, target)
+                os.chmod(target, os.stat(obj).st_mode | stat.S_IWUSR)
+                return
+        if link:
+            try:
+                os.link(obj, target)
+                return
+            except OSError:  # e.g. different file systems
+                pass
+        shutil.copy2(obj, target)
+        os.chmod(target, os.stat(obj).st_mode | stat.S_IWUSR)
+
+    def gc(self):
+        """
+        Remove objects that no snapshot or source file needs anymore and return their number
+
+        Kept are objects with hardlinks (snapshots of runs still on this
+        machine), the current contents of source files seen before, and
+        objects stored in the last STORE_GRACE seconds, which a snapshot in
+        progress may be about to place. Files that changed since are dropped
+        from the hash cache. Clones and copies do not need their objects.
+        """
+        for key, (size, mtime_ns, digest) in list(self.stat_cache.items()):
+            try:
+                st = os.stat(key)
+            except OSError:
+                st = None
+            if st is None or [st.st_size, st.st_mtime_ns] != [size, mtime_ns]:
+                del self.stat_cache[key]
+        needed = {digest for _, _, digest in self.stat_cache.values()}
+        removed = 0
+        for folder in glob.glob(os.path.join(self.path, '??')):
+            for name in os.listdir(folder):
+                path = os.path.join(folder, name)
+                digest = os.path.basename(folder) + name
+                if len(digest) != 40 or digest in needed:  # or a temporary file
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if st.st_nlink > 1 or time.time() - st.st_ctime < STORE_GRACE:
+                    continue
+                os.remove(path)
+                removed += 1
+        self.save_stat_cache()
+        return removed
+
+    def save_stat_cache(self):
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.stat_cache, f)
+        os.replace(tmp_path, self.stat_cache_path)
+
+    def snapshot(self, src, dest):
+        """
+        Snapshot source files from `src` into `dest` and return the manifest
+
+        The manifest maps file paths relative to `src` to their hashes.
+        """
+        manifest = {}
+        for relpath in list_source_files(src):
+            digest = self.add(os.path.join(src, relpath))
+            manifest[relpath] = digest
+            target = os.path.join(dest, relpath)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            self.place(self.object_path(digest), target,
+                       self.link and not is_excluded(relpath, self.copy))
+        self.save_stat_cache()
+        return manifest
 
 
 def on_exit(local_memo_dir):
     """
     Appends end time stamp after the process is over and syncs to db
-    """    
+    """
     meta_path = os.path.join(local_memo_dir, 'meta.json')
     try:
         rec = json.load(open(meta_path, 'r'))
     except:
         time.sleep(1)
         rec = json.load(open(meta_path, 'r'))
-    rec['end_time'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    json.dump(rec, open(meta_path, 'w'), indent=4)
+    rec['end time'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    write_meta(local_memo_dir, rec)
 
     db_memo = get_remote_env_var('MEMO', CONFIG['db']['user'], CONFIG['db']['host'])
     memo_id = get_memo_id(local_memo_dir)
     db_memo_dir = os.path.join(db_memo, memo_id)
-    sync(local_memo_dir, db_memo_dir)
+    sync(local_memo_dir, db_memo_dir, exclude=get_sync_config()[1],
+         link_dest=get_source_parent(local_memo_dir))
     shutil.rmtree(local_memo_dir)
 
 
+STATS_INTERVAL = 60  # seconds between resource usage updates of a running job
+
+
+def set_job_state(memo_dir, state, **fields):
+    """
+    Record the state of a run's job in its meta.json, if the run is still there
+    """
+    try:
+        rec = json.load(open(os.path.join(memo_dir, 'meta.json'), 'r'))
+    except (OSError, ValueError):
+        return
+    rec['job state'] = state
+    rec.update(fields)
+    write_meta(memo_dir, rec)
+
+
+def get_job_id():
+    """
+    Get the id of the scheduler or queue job we are running in, if any
+    """
+    if 'SLURM_ARRAY_JOB_ID' in os.environ:
+        return f"{os.environ['SLURM_ARRAY_JOB_ID']}_{os.environ['SLURM_ARRAY_TASK_ID']}"
+    for name in ['SLURM_JOB_ID', 'PBS_JOBID', 'MEMO_JOB_ID']:
+        if name in os.environ:
+            return os.environ[name]
+    return None
+
+
+def get_tree_usage(pid):
+    """
+    Get the CPU time (s) and RSS (bytes) of a process and all its descendants
+
+    CPU time includes children that already exited.
+    """
+    children = {}
+    stats = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # the command name may contain spaces, so split after it
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:  # exited in the meantime
+            continue
+        stats[int(entry)] = fields
+        children.setdefault(int(fields[1]), []).append(int(entry))
+    ticks = os.sysconf('SC_CLK_TCK')
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    cpu_time = rss = 0
+    todo = [pid]
+    while todo:
+        p = todo.pop()
+        if p not in stats:
+            continue
+        fields = stats[p]
+        # utime, stime, cutime, cstime and rss (in pages), see proc(5)
+        cpu_time += sum(int(v) for v in fields[11:15]) / ticks
+        rss += int(fields[21]) * page_size
+        todo += children.get(p, [])
+    return cpu_time, rss
+
+
+def track(memo_dir, command):
+    """
+    Run the command of a job and record its resource usage in meta.json
+
+    Job id and queue wait are recorded when the command starts. While it runs,
+    CPU time and peak RSS of its processes are read from /proc every
+    STATS_INTERVAL seconds, so watch_and_sync pushes them to db. At the end,
+    the exit code, wall time and final totals from getrusage are recorded.
+    Returns the exit code.
+    """
+    start = time.time()
+    rec = json.load(open(os.path.join(memo_dir, 'meta.json'), 'r'))
+    submitted = rec.get('submit time')
+    fields = {'job id': get_job_id() or rec.get('job id'),
+              'queue wait': None if submitted is None else round(start - submitted, 1)}
+    set_job_state(memo_dir, 'running', **fields)
+
+    p = subprocess.Popen(command)
+    for signum in [signal.SIGINT, signal.SIGTERM, signal.SIGHUP]:
+        signal.signal(signum, lambda signum, frame: p.send_signal(signum))
+    peak_rss = 0
+    while True:
+        try:
+            p.wait(timeout=STATS_INTERVAL)
+            break
+        except subprocess.TimeoutExpired:
+            cpu_time, rss = get_tree_usage(p.pid)
+            peak_rss = max(peak_rss, rss)
+            set_job_state(memo_dir, 'running', **{
+                'wall time': round(time.time() - start, 1),
+                'cpu time': round(cpu_time, 1), 'peak rss': peak_rss})
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # killed by a signal is reported like the shell does
+    exit_code = p.returncode if p.returncode >= 0 else 128 - p.returncode
+    set_job_state(memo_dir, 'completed' if exit_code == 0 else 'failed', **{
+        'exit code': exit_code,
+        'wall time': round(time.time() - start, 1),
+        'cpu time': round(usage.ru_utime + usage.ru_stime, 1),
+        'peak rss': max(peak_rss, usage.ru_maxrss * 1024)})  # ru_maxrss is in KB
+    return exit_code
+
+
+QUEUE_PATH = os.path.join(DATA_DIR, '.queue.sqlite')  # jobs waiting on this machine
+QUEUE_LOCK = os.path.join(DATA_DIR, '.queue.lock')  # held by the running worker
+QUEUE_POLL = 1  # seconds between scheduling rounds of the worker
+QUEUE_IDLE = 60  # seconds an idle worker waits for new jobs before exiting
+
+
+def get_queue_config():
+    """
+    Get the max number of concurrent jobs and the GPUs to hand out
+
+    GPUs come from the [queue] section of the config, else from the worker's
+    CUDA_VISIBLE_DEVICES, else from nvidia-smi. By default there is one job
+    per GPU, or one per CPU on machines without GPUs.
+    """
+    gpus = CONFIG.get('queue', 'gpus', fallback=os.environ.get('CUDA_VISIBLE_DEVICES'))
+    if gpus is None:
+        try:
+            gpus = subprocess.run(['nvidia-smi', '--query-gpu=index', '--format=csv,noheader'],
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                  check=True).stdout.decode()
+        except (OSError, subprocess.CalledProcessError):
+            gpus = ''
+    gpus = [g.strip() for g in gpus.replace('\n', ',').split(',') if g.strip()]
+    max_jobs = CONFIG.getint('queue', 'max_jobs', fallback=len(gpus) or os.cpu_count())
+    return max_jobs, gpus
+
+
+class JobQueue(object):
+    """
+    Persistent queue of runs executed one by one on this machine
+
+    Jobs wait in $MEMO/.queue.sqlite until the worker (`memo queue worker`,
+    started on demand) has a free job slot and enough free GPUs for them.
+    Jobs with a higher priority go first, otherwise they start in the order
+    they were submitted. A job that does not fit yet holds back the ones
+    behind it, so large jobs are not starved by small ones.
+    """
+
+    def __init__(self, path=QUEUE_PATH):
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                          'id INTEGER PRIMARY KEY AUTOINCREMENT, memo_dir TEXT, '
+                          'gpus INTEGER, priority INTEGER, state TEXT, pid INTEGER, '
+                          'devices TEXT, submitted REAL, started REAL, ended REAL, '
+                          'exit_code INTEGER, announced INTEGER DEFAULT 0, '
+                          'pid_start INTEGER)')
+        try:  # queues made before pid_start was added
+            self.conn.execute('ALTER TABLE jobs ADD COLUMN pid_start INTEGER')
+        except sqlite3.OperationalError:
+            pass
+
+    def submit(self, memo_dir, gpus=None, priority=0):
+        """
+        Queue the run.sh in memo_dir and make sure a worker is running
+
+        With `gpus` None, a job gets one GPU if the machine has any. Raises
+        ValueError if the job needs more GPUs than the queue hands out, as it
+        would hold back the queue forever.
+        """
+        devices = get_queue_config()[1]
+        if gpus is not None and gpus > len(devices):
+            raise ValueError(f'Job needs {gpus} GPUs but the queue only has '
+                             f'{len(devices)} ({",".join(devices) or "none"})')
+        memo_dir = os.path.abspath(memo_dir)
+        set_job_state(memo_dir, 'pending')
+        job_id = self.conn.execute(
+            'INSERT INTO jobs (memo_dir, gpus, priority, state, submitted) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (memo_dir, gpus, priority, 'queued', time.time())).lastrowid
+        start_queue_worker()
+        return job_id
+
+    def jobs(self, states=('queued', 'running')):
+        marks = ', '.join('?' * len(states))
+        cur = self.conn.execute(
+            f'SELECT id, memo_dir, gpus, priority, state, pid, devices, announced, pid_start '
+            f'FROM jobs WHERE state IN ({marks}) ORDER BY priority DESC, id', states)
+        return cur.fetchall()
+
+    def update(self, job_id, **fields):
+        assignments = ', '.join(f'{k} = ?' for k in fields)
+        self.conn.execute(f'UPDATE jobs SET {assignments} WHERE id = ?',
+                          list(fields.values()) + [job_id])
+
+
+def start_queue_worker():
+    """
+    Start a queue worker in the background unless one is already running
+    """
+    with open(QUEUE_LOCK, 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:  # the worker holds the lock
+            return
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), 'queue', 'worker'],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def get_process_start(pid):
+    """
+    Get when a process started (in clock ticks after boot), None if it is gone
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return int(f.read().rsplit(')', 1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def is_running(pid, start=None):
+    """
+    Check if a process is alive and, given its start, not a reuse of its pid
+    """
+    if start is not None:
+        return get_process_start(pid) == start
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def queue_worker():
+    """
+    Start queued jobs as job slots and GPUs free up
+
+    Each job gets its GPUs through CUDA_VISIBLE_DEVICES and its output goes to
+    log.out in the run folder. Queued runs are announced to the db right away,
+    so they show up in the browser before they start. The worker exits after
+    QUEUE_IDLE seconds without jobs; only one worker runs per $MEMO.
+    """
+    lock = open(QUEUE_LOCK, 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return
+    queue = JobQueue()
+    max_jobs, devices = get_queue_config()
+    procs = {}  # job id -> Popen of jobs started by this worker
+    idle_since = time.time()
+    while True:
+        jobs = queue.jobs()
+        for job_id, memo_dir, _, _, state, pid, _, _, pid_start in jobs:
+            if state != 'running':
+                continue
+            if job_id in procs:  # our own child, so we also get its exit code
+                exit_code = procs[job_id].poll()
+                if exit_code is None:
+                    continue
+                del procs[job_id]
+            elif is_running(pid, pid_start):  # left running by a previous worker
+                continue
+            else:
+                exit_code = None
+            queue.update(job_id, state='done', ended=time.time(), exit_code=exit_code)
+            # only runs that are not recorded are still here, the others were
+            # removed by on_exit after `track` recorded how they ended
+            if exit_code is not None:
+                set_job_state(memo_dir, 'completed' if exit_code == 0 else 'failed',
+                              **{'exit code': exit_code})
+
+        jobs = queue.jobs()
+        running = [job for job in jobs if job[4] == 'running']
+        busy = {d for job in running for d in (job[6] or '').split(',')}
+        free = [d for d in devices if d not in busy]
+        nrunning = len(running)
+        blocked = False  # strictly in order, so later jobs wait too
+        waiting = []
+        for job_id, memo_dir, gpus, _, state, _, _, announced, _ in jobs:
+            if state != 'queued':
+                continue
+            if gpus is None:
+                gpus = 1 if devices else 0
+            if gpus > len(devices):  # submitted before the GPUs were reconfigured
+                queue.update(job_id, state='rejected', ended=time.time())
+                continue
+            blocked = blocked or nrunning >= max_jobs or gpus > len(free)
+            if blocked:
+                if not announced:
+                    waiting.append((job_id, memo_dir))
+                continue
+            if not os.path.isfile(os.path.join(memo_dir, 'run.sh')):
+                queue.update(job_id, state='missing', ended=time.time())
+                continue
+            assigned, free = free[:gpus], free[gpus:]
+            env = dict(os.environ, CUDA_VISIBLE_DEVICES=','.join(assigned),
+                       MEMO_JOB_ID=str(job_id))
+            set_job_state(memo_dir, 'running', **{'queue gpus': assigned})
+            logfile = open(os.path.join(memo_dir, 'log.out'), 'a')
+            p = subprocess.Popen(['sh', 'run.sh'], cwd=memo_dir, env=env,
+                                 stdin=subprocess.DEVNULL, stdout=logfile,
+                                 stderr=subprocess.STDOUT, start_new_session=True)
+            logfile.close()
+            procs[job_id] = p
+            queue.update(job_id, state='running', pid=p.pid,
+                         pid_start=get_process_start(p.pid),
+                         devices=','.join(assigned), started=time.time())
+            nrunning += 1
+        # running jobs are synced by themselves
+        for job_id, memo_dir in waiting:
+            announce_job(memo_dir)
+            queue.update(job_id, announced=1)
+
+        if jobs:
+            idle_since = time.time()
+        elif time.time() - idle_since > QUEUE_IDLE:
+            # a job submitted just now may have seen the lock held and left
+            # it to us, so look once more without holding it
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            if not queue.jobs():
+                break
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:  # a new worker took over
+                break
+            idle_since = time.time()
+        time.sleep(QUEUE_POLL)
+
+
+def announce_job(memo_dir):
+    """
+    Send the meta.json of a queued run to db, unless the run is not recorded
+    """
+    try:
+        rec = json.load(open(os.path.join(memo_dir, 'meta.json'), 'r'))
+        if rec.get('no_record'):
+            return
+        db_memo = get_remote_env_var('MEMO', CONFIG['db']['user'], CONFIG['db']['host'])
+        sync(memo_dir, os.path.join(db_memo, rec['memo_id']), paths=['meta.json'])
+    except Exception as err:  # the run is synced in full once it starts anyway
+        print(f'Could not announce {memo_dir} ({err})')
+
+
+def queue_main(argv):
+    parser = argparse.ArgumentParser(prog='memo queue')
+    commands = parser.add_subparsers(dest='command', required=True)
+    submit = commands.add_parser('submit', help='Queue the run.sh of a run folder.')
+    submit.add_argument('memo_dir', nargs='+')
+    submit.add_argument('--gpus', default=None, type=int)
+    submit.add_argument('--priority', default=0, type=int)
+    commands.add_parser('worker', help='Run queued jobs (started automatically).')
+    commands.add_parser('status', help='List queued and running jobs.')
+    args = parser.parse_args(argv)
+
+    if args.command == 'worker':
+        queue_worker()
+        return
+    queue = JobQueue()
+    if args.command == 'submit':
+        for memo_dir in args.memo_dir:
+            try:
+                job_id = queue.submit(memo_dir, gpus=args.gpus, priority=args.priority)
+            except ValueError as err:
+                parser.error(str(err))
+            print('queued job', job_id, memo_dir)
+    else:
+        for job_id, memo_dir, gpus, priority, state, _, devices, _, _ in queue.jobs():
+            gpus = devices if state == 'running' else gpus
+            print(job_id, state, f'priority {priority}', f'gpus {gpus}', memo_dir)
+
+
 class Local(object):
 
     cluster = 'localhost'
     host = 'localhost'
     executor = 'sh'
+    queue = True  # runs go through the job queue of the host (see JobQueue)
 
     def __init__(self, tmp_dir=None, no_record=False):
         self.no_record = no_record
@@ -147,11 +1470,12 @@ class Local(object):
         self.args = None
 
         # memo_idx = ''.join(random.SystemRandom().choice(string.ascii_lowercase) for _ in range(4))
-        self.memo_id = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        self.memo_id = new_memo_id()
 
         local_host = get_host_properties()[0]
         if local_host == self.host:
-            self.memo_dir = tempfile.mkdtemp() + os.path.sep
+            os.makedirs(RUNS_PATH, exist_ok=True)
+            self.memo_dir = tempfile.mkdtemp(dir=RUNS_PATH) + os.path.sep
         else:
             if tmp_dir is None:
                 command = 'mktemp -d'
@@ -167,7 +1491,19 @@ class Local(object):
         self.project_path = os.path.abspath(os.getcwd())
 
     def parser(self, args):
-        return args
+        # -h and --help are left to the script
+        parser = argparse.ArgumentParser(allow_abbrev=False, add_help=False)
+        parser.add_argument('--queue_gpus', default=None, type=int)
+        parser.add_argument('--queue_priority', default=0, type=int)
+        parser.add_argument('--no_queue', action='store_true', default=False)
+        self.args, script_args = parser.parse_known_args(args)
+        return script_args
+
+    def queue_options(self):
+        options = f'--priority {self.args.queue_priority}'
+        if self.args.queue_gpus is not None:
+            options += f' --gpus {self.args.queue_gpus}'
+        return options
 
     def gen_batch_script(self, command, working_dir, prefix=None):
         script = '#!/bin/sh'
@@ -182,16 +1518,57 @@ class Local(object):
                    f'cd {working_dir}',
                    f'export MEMO_DIR={self.memo_dir}',
                    f'export PROJECT_PATH={self.project_path}']
-        if not self.no_record:
+        if self.no_record:
+            script += [command,
+                       'EXIT_CODE=$?']
+        else:
             script += [f'nohup memo watch_and_sync {self.memo_dir} -- '
-                       f'--memo_id {self.memo_id} &']
-        script += ['WATCH_PID=$!',
-                   command,
-                   'kill $WATCH_PID']
-        if not self.no_record:
-            script += [f'memo on_exit {self.memo_dir}']
+                       f'--memo_id {self.memo_id} &',
+                       'WATCH_PID=$!',
+                       f'memo track {self.memo_dir} -- {command}',
+                       'EXIT_CODE=$?',
+                       'kill $WATCH_PID',
+                       f'memo on_exit {self.memo_dir}']
+        script += ['exit $EXIT_CODE']
         return script
 
+    def gen_array_script(self, run_dirs):
+        """
+        Generate a script submitting all runs of a sweep as one job array
+
+        Returns None if the cluster has no job arrays, in which case each
+        run.sh is submitted separately.
+        """
+        return None
+
+    def job_ids(self, out, nruns, array=False):
+        """
+        Get the scheduler job id of each run from the output of its submission
+        """
+        return [None] * nruns
+
+    @classmethod
+    def job_states(cls, user, host):
+        """
+        Ask the scheduler of a host which jobs it still has
+
+        Returns {job id: 'pending' or 'running'}, with job ids cut at their
+        first dot, or None if the scheduler could not be asked. Here it is
+        the job queue of the host, on this machine for 'localhost'.
+        """
+        if host == 'localhost':
+            if not os.path.exists(QUEUE_PATH):
+                return {}
+            jobs = [(job_id, state) for job_id, _, _, _, state, *_ in JobQueue().jobs()]
+        else:
+            try:
+                out = exec_remote('memo queue status', user, host, check=True)
+            except subprocess.CalledProcessError:
+                return None
+            jobs = re.findall(r'^(\d+) (queued|running) ', out, flags=re.MULTILINE)
+        return {str(job_id): 'pending' if state == 'queued' else 'running'
+                for job_id, state in jobs}
+
     def exec_remote(self, command):
         return exec_remote(command, self.user, self.host)
 
@@ -216,6 +1593,7 @@ class OpenMind(Local):
     cluster = 'om'
     host = 'openmind7.mit.edu'
     executor = 'sbatch'
+    queue = False
 
     def parser(self, args):
         parser = argparse.ArgumentParser()
@@ -231,7 +1609,7 @@ class OpenMind(Local):
         self.args, script_args = parser.parse_known_args(args)
         return script_args
 
-    def gen_batch_script(self, command, working_dir):
+    def sbatch_options(self):
         prefix = []
         for k, v in self.args.__dict__.items():
             key = k.replace('_', '-')
@@ -257,7 +1635,10 @@ class OpenMind(Local):
 
             if not skip:
                 prefix.append(f'#SBATCH {key}={v}')
+        return prefix
 
+    def gen_batch_script(self, command, working_dir):
+        prefix = self.sbatch_options()
         if self.args.singularity:
             command = (f'singularity exec --bind /braintree:/braintree '
                         f'--bind /home:/home --bind /om:/om --nv '
@@ -265,12 +1646,39 @@ class OpenMind(Local):
                         f'{command}')
         return super().gen_batch_script(command, working_dir, prefix=prefix)
 
+    def gen_array_script(self, run_dirs):
+        script = (['#!/bin/sh'] + self.sbatch_options() +
+                  [f'#SBATCH --array=0-{len(run_dirs) - 1}',
+                   '',
+                   'set -- ' + ' '.join(run_dirs),
+                   'shift $SLURM_ARRAY_TASK_ID',
+                   'cd $1',
+                   'sh run.sh > log.out 2> log.err'])
+        return script
+
+    def job_ids(self, out, nruns, array=False):
+        ids = re.findall(r'Submitted batch job (\d+)', out)
+        if array and ids:
+            return [f'{ids[0]}_{i}' for i in range(nruns)]
+        return (ids + [None] * nruns)[:nruns]
+
+    @classmethod
+    def job_states(cls, user, host):
+        # -r lists array tasks one by one, as in 123_4
+        try:
+            out = exec_remote(f'squeue -h -r -u {user} -o "%i %T"', user, host, check=True)
+        except subprocess.CalledProcessError:
+            return None
+        return {job_id: 'pending' if state == 'PENDING' else 'running'
+                for job_id, state in re.findall(r'^(\S+) ([A-Z_]+)$', out, flags=re.MULTILINE)}
+
 
 class VSC(Local):
 
     cluster = 'vsc'
     host = 'login1-tier2.hpc.kuleuven.be'
     executor = 'qsub'
+    queue = False
 
     def __init__(self, tmp_dir=None, *args, **kwargs):
         # /tmp is not shared in the cluster so we need a user-level folder
@@ -293,7 +1701,7 @@ class VSC(Local):
         self.args, script_args = parser.parse_known_args(args)
         return script_args
 
-    def gen_batch_script(self, command, working_dir):
+    def pbs_options(self):
         l_options = ['time', 'pmem', 'pvmem', 'qos']
         l_list = []
         pbs = []
@@ -322,6 +1730,10 @@ class VSC(Local):
             l_list += [f'nodes={nodes}:ppn={9 * gpus}:gpus={gpus}',
                        'partition=gpu']
         pbs.append('-l ' + ",".join(l_list))
+        return pbs
+
+    def gen_batch_script(self, command, working_dir):
+        pbs = self.pbs_options()
         pbs.append(f'-o {self.memo_dir}/log.out')
         pbs.append(f'-e {self.memo_dir}/log.err')
         pbs = ' '.join(pbs)
@@ -329,6 +1741,46 @@ class VSC(Local):
         return super().gen_batch_script(command, working_dir,
                                         prefix=(f'#PBS {pbs}', f'cd {self.memo_dir}'))
 
+    def gen_array_script(self, run_dirs):
+        pbs = self.pbs_options()
+        pbs.append(f'-t 0-{len(run_dirs) - 1}')
+        pbs.append('-o /dev/null -e /dev/null')  # each run logs into its own folder
+        script = ['#!/bin/sh',
+                  f'#PBS {" ".join(pbs)}',
+                  '',
+                  'set -- ' + ' '.join(run_dirs),
+                  'shift $PBS_ARRAYID',
+                  'cd $1',
+                  'sh run.sh > log.out 2> log.err']
+        return script
+
+    def job_ids(self, out, nruns, array=False):
+        # e.g. 123.tier2-p-moab-2 or 123[].tier2-p-moab-2 for job arrays
+        ids = re.findall(r'^(\d+(\[\])?\S*)$', out, flags=re.MULTILINE)
+        ids = [i for i, _ in ids]
+        if array and ids:
+            return [ids[0].replace('[]', f'[{i}]') for i in range(nruns)]
+        return (ids + [None] * nruns)[:nruns]
+
+    @classmethod
+    def job_states(cls, user, host):
+        # the state is the second to last column, and completed (C) jobs
+        # linger for a while; long job ids are cut, hence only up to the dot
+        try:
+            out = exec_remote(f'qstat -t -u {user}', user, host, check=True)
+        except subprocess.CalledProcessError:
+            return None
+        states = {}
+        for line in out.splitlines():
+            fields = line.split()
+            if len(fields) < 3 or not re.match(r'\d+(\[\d+\])?(\.|$)', fields[0]):
+                continue
+            if fields[-2] in ('Q', 'H', 'W', 'T'):
+                states[fields[0].split('.')[0]] = 'pending'
+            elif fields[-2] in ('R', 'E'):
+                states[fields[0].split('.')[0]] = 'running'
+        return states
+
 
 class Enuui(Local):
 
@@ -337,6 +1789,25 @@ class Enuui(Local):
     executor = 'sh'
 
 
+def expand_sweep(sweep_file=None, grid=()):
+    """
+    Expand a sweep file and grid options into a list of script argument lists
+
+    Every non-empty, non-comment line of the sweep file is one set of script
+    arguments. Every `name=v1,v2,...` grid option multiplies the sets by its
+    values, passed as `--name v`.
+    """
+    arg_sets = [[]]
+    if sweep_file is not None:
+        with open(sweep_file) as f:
+            arg_sets = [shlex.split(line) for line in f
+                        if line.strip() and not line.strip().startswith('#')]
+    for option in grid:
+        name, values = option.split('=', 1)
+        arg_sets = [s + [f'--{name}', v] for s in arg_sets for v in values.split(',')]
+    return arg_sets
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('executable')
@@ -351,8 +1822,21 @@ def main():
     parser.add_argument('--no_record', action='store_true', default=False,
                         help='Choose if you do not want to store any record in the'
                              'database. Useful for debugging.')
+    parser.add_argument('--sweep', default=None,
+                        help='File with one set of extra script arguments per line; '
+                             'each line is launched as a separate run.')
+    parser.add_argument('--grid', action='append', default=[],
+                        help='Sweep over values of a script argument, e.g. '
+                             '--grid lr=0.1,0.01 launches runs with --lr 0.1 and '
+                             '--lr 0.01. Can be repeated to sweep over a grid.')
+    parser.add_argument('--timings', action='store_true', default=False,
+                        help='Print how long each phase of the launch took.')
 
     args, extra_args = parser.parse_known_args()    
+    is_sweep = args.sweep is not None or len(args.grid) > 0
+    if is_sweep and args.follow:
+        parser.error('--follow cannot be used with sweeps')
+    timer = PhaseTimer()
     local_host, cluster, node = get_host_properties()  
     if args.cluster is None:  # run where you currently are
         args.cluster = cluster
@@ -364,119 +1848,184 @@ def main():
     else:
         cluster = cluster(no_record=args.no_record)
     remote = local_host != cluster.host
+    timer.done('setup')
 
     # Parse host-specific arguments
     script_args = cluster.parser(extra_args)
 
-    # Form call command
-    # if os.path.basename(args.executable) == 'python':
-    #     ex = sys.executable
-    # else:
-    ex = args.executable
-    script_args_str = ' '.join([shlex.quote(s) for s in script_args])
-
-    # Add memo_id to the command for easy tracking
-    sep = ' -- ' if ' -- ' not in script_args_str else ' '
-    command = f'{ex} {args.script} {script_args_str}{sep}--memo_id {cluster.memo_id}'
-
     # get git details
-    is_git_repo = get_local_output('git rev-parse --is-inside-work-tree')
-    if is_git_repo == 'true':
-        git_commit = get_local_output('git rev-parse HEAD')
-        remote_url = get_local_output('git remote get-url origin')
-        if 'github.com' in remote_url:
-            if remote_url.startswith('git@github.com'):
-                repo = remote_url.split(":")[1][:-4]  # strip .git
-                remote_url = f'https://github.com/{repo}'
-        else:
-            remote_url = None
-        copy_path = get_local_output('git rev-parse --show-toplevel')
-    else:
-        git_commit = None
-        remote_url = None
-        copy_path = os.listdir(os.getcwd())
+    copy_path, git_commit, remote_url = get_git_info()
+    if copy_path is None:
+        copy_path = os.getcwd()
+    diff = os.path.relpath(os.getcwd(), copy_path)
+    timer.done('git')
 
-    # Define working dir where we will cd to
-    if remote:
-        run_dir = cluster.memo_dir
-    else:
-        if args.keep_cwd:
-            run_dir = os.getcwd()
+    # A sweep gets one folder per run inside the memo_dir set up by the cluster
+    sweep_id = cluster.memo_id if is_sweep else None
+    sweep_dir = cluster.memo_dir
+    if remote:  # need to set up a local folder first
+        if not args.dry:
+            os.makedirs(RUNS_PATH, exist_ok=True)
+        local_sweep_dir = None if args.dry else tempfile.mkdtemp(dir=RUNS_PATH)
+    else:  # local folder is already available
+        local_sweep_dir = cluster.memo_dir
+    if not args.dry:
+        print('Local memo dir:', local_sweep_dir)
+        store = SourceStore()
+    source_parent = read_cache(f'last run {copy_path}', max_age=float('inf'))
+
+    runs = []  # (run_dir, local_memo_dir) pairs
+    for sweep_args in expand_sweep(args.sweep, args.grid) if is_sweep else [[]]:
+        if is_sweep:
+            cluster.memo_id = new_memo_id()
+            cluster.memo_dir = os.path.join(sweep_dir, cluster.memo_id) + os.path.sep
+            print('memo id:', cluster.memo_id, ' '.join(sweep_args))
+        # sweep arguments go before any arguments following a '--'
+        run_args = list(script_args)
+        idx = run_args.index('--') if '--' in run_args else len(run_args)
+        run_args[idx:idx] = sweep_args
+
+        # Form call command
+        # if os.path.basename(args.executable) == 'python':
+        #     ex = sys.executable
+        # else:
+        ex = args.executable
+        script_args_str = ' '.join([shlex.quote(s) for s in run_args])
+
+        # Add memo_id to the command for easy tracking
+        sep = ' -- ' if ' -- ' not in script_args_str else ' '
+        command = f'{ex} {args.script} {script_args_str}{sep}--memo_id {cluster.memo_id}'
+
+        # Define working dir where we will cd to
+        if remote:
+            run_dir = cluster.memo_dir
         else:
-            run_dir = os.path.expandvars(cluster.memo_dir)
+            if args.keep_cwd:
+                run_dir = os.getcwd()
+            else:
+                run_dir = os.path.expandvars(cluster.memo_dir)
+
+        working_dir = os.path.join(run_dir, 'source', diff)
+
+        # Prepare run.sh script
+        script = cluster.gen_batch_script(command, working_dir)
+
+        # Define what to store in meta.json
+        rec = {'start time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+               'end time': None,
+               'submit time': time.time(),  # for the queue wait, whatever the time zones
+               'job id': None,
+               'job state': 'pending',
+               'full command': ' '.join(sys.argv),
+               'local host': local_host,
+               'working dir': os.path.abspath(os.getcwd()),
+               'remote host': cluster.host,
+               'user': cluster.user,
+               'cluster args': getattr(cluster.args, '__dict__', None),
+               'script args': run_args,
+               'outcome': '',
+               'github url': remote_url,
+               'git commit': git_commit,
+               'show': True,
+               'memo_id': cluster.memo_id,
+               'source parent': source_parent,
+               'sweep id': sweep_id,
+               }
+        rec.update(args.__dict__)    
+
+        # Copy everything to memo_dir
+        local_memo_dir = None
+        if not args.dry:
+            if is_sweep:
+                local_memo_dir = os.path.join(local_sweep_dir, cluster.memo_id)
+                os.makedirs(local_memo_dir)
+            else:
+                local_memo_dir = local_sweep_dir
+            manifest = store.snapshot(copy_path, os.path.join(local_memo_dir, 'source'))
+            with open(os.path.join(local_memo_dir, 'source.json'), 'w') as f:
+                json.dump(manifest, f, indent=4)
+            source_parent = cluster.memo_id
+            write_cache(f'last run {copy_path}', cluster.memo_id)
+
+            with open(os.path.join(local_memo_dir, 'run.sh'), 'w') as f:
+                f.write('\n'.join(script))
+            write_meta(local_memo_dir, rec)
+        runs.append((run_dir, local_memo_dir))
+    timer.done('snapshot')
+
+    array_script = cluster.gen_array_script([r for r, _ in runs]) if is_sweep else None
+    if array_script is not None and not args.dry:
+        with open(os.path.join(local_sweep_dir, 'array.sh'), 'w') as f:
+            f.write('\n'.join(array_script))
 
-    diff = os.path.relpath(os.getcwd(), copy_path)
-    working_dir = os.path.join(run_dir, 'source', diff)
-
-    # Prepare run.sh script
-    script = cluster.gen_batch_script(command, working_dir)
-
-    # Define what to store in meta.json
-    rec = {'start time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-           'end time': None,
-           'full command': ' '.join(sys.argv),
-           'local host': local_host,
-           'working dir': os.path.abspath(os.getcwd()),
-           'remote host': cluster.host,
-           'user': cluster.user,
-           'cluster args': getattr(cluster.args, '__dict__', None),
-           'script args': script_args,
-           'outcome': '',
-           'github url': remote_url,
-           'git commit': git_commit,
-           'show': True,
-           'memo_id': cluster.memo_id,
-           }
-    rec.update(args.__dict__)    
-
-    # Copy everything to memo_dir
     login = f'{cluster.user}@{cluster.host}'
-    if not args.dry:
-        if remote:  # need to set up a local folder first
-            local_memo_dir = tempfile.mkdtemp()
-        else:  # local folder is already available
-            local_memo_dir = cluster.memo_dir
-        print('Local memo dir:', local_memo_dir)
-        shutil.copytree(copy_path, os.path.join(local_memo_dir, 'source'))
-        
-        with open(os.path.join(local_memo_dir, 'run.sh'), 'w') as f:
-            f.write('\n'.join(script))
-        with open(os.path.join(local_memo_dir, 'meta.json'), 'w') as meta_file:
-            json.dump(rec, meta_file, indent=4)
-        if remote:                 
-            copy_files = ['rsync', '-aq',
-                          f'{local_memo_dir}/',
-                          f'{login}:{cluster.memo_dir}']
-            print('Remote memo dir:', cluster.memo_dir)
-            out = subprocess.run(' '.join(copy_files), shell=True, check=True)
+    if remote and not args.dry:
+        # -H so that source files shared by sweep runs are sent only once
+        copy_files = rsync_command(cluster.user, cluster.host) + [
+                      '-H', f'{local_sweep_dir}/', f'{login}:{sweep_dir}']
+        print('Remote memo dir:', sweep_dir)
+        out = subprocess.run(copy_files, check=True)
+        timer.done('copy')
 
     # Call run.sh
     call_args = [cluster.executor, 'run.sh']
+    use_queue = cluster.queue and not cluster.args.no_queue and not args.follow
 
     if remote:
-        bash_cmd = f'cd {run_dir}; ' + ' '.join(call_args)
+        if array_script is not None:
+            bash_cmd = f'cd {sweep_dir}; {cluster.executor} array.sh'
+        elif use_queue:  # the queue worker on the host starts them
+            bash_cmd = (f'memo queue submit {cluster.queue_options()} ' +
+                        ' '.join(run_dir for run_dir, _ in runs))
+        elif is_sweep and cluster.executor == 'sh':  # start all runs in the background
+            # '&' already ends each command, and bash rejects '&;'
+            bash_cmd = ' '.join(f'cd {run_dir}; nohup sh run.sh > log.out 2>&1 &'
+                                for run_dir, _ in runs)
+        else:  # submit all runs in one session
+            bash_cmd = '; '.join(f'cd {run_dir}; ' + ' '.join(call_args)
+                                 for run_dir, _ in runs)
         if not args.dry:
             out = cluster.exec_remote(bash_cmd)        
             # if args.cluster == 'om':  # print job id
             print(out.rstrip('\n'))
-
-    else:
-        local_memo_dir = os.path.expandvars(local_memo_dir)
-
-        if not args.follow:
-            logfile = os.path.join(local_memo_dir, 'log.out')
-            subprocess.Popen(['nohup'] + call_args, cwd=run_dir,
-                             stdin=subprocess.DEVNULL,
-                             stdout=open(logfile, 'a'),
-                             stderr=open(logfile, 'a'))
-            time.sleep(1)
-            subprocess.Popen(['cat', logfile])
-        else:
-            p = subprocess.Popen(call_args, cwd=run_dir)
-            try:
-                p.wait()
-            except KeyboardInterrupt:
-                p.terminate()
+            job_ids = cluster.job_ids(out, len(runs), array=array_script is not None)
+            # runs waiting for the scheduler show up in db with their job id
+            for (_, local_memo_dir), job_id in zip(runs, job_ids):
+                if job_id is not None:
+                    set_job_state(local_memo_dir, 'pending', **{'job id': job_id})
+                    announce_job(local_memo_dir)
+            shutil.rmtree(local_sweep_dir)  # the runs live on the cluster now
+
+    elif not args.dry:
+        queue = JobQueue() if use_queue else None
+        for run_dir, local_memo_dir in runs:
+            local_memo_dir = os.path.expandvars(local_memo_dir)
+
+            if use_queue:
+                try:
+                    job_id = queue.submit(local_memo_dir, gpus=cluster.args.queue_gpus,
+                                          priority=cluster.args.queue_priority)
+                except ValueError as err:
+                    sys.exit(f'memo: {err}')
+                print('queued job', job_id)
+            elif not args.follow:
+                logfile = os.path.join(local_memo_dir, 'log.out')
+                subprocess.Popen(['nohup'] + call_args, cwd=run_dir,
+                                 stdin=subprocess.DEVNULL,
+                                 stdout=open(logfile, 'a'),
+                                 stderr=open(logfile, 'a'))
+                if not is_sweep and sys.stdout.isatty():  # show the first output
+                    time.sleep(1)
+                    subprocess.Popen(['cat', logfile])
+            else:
+                p = subprocess.Popen(call_args, cwd=run_dir)
+                try:
+                    p.wait()
+                except KeyboardInterrupt:
+                    p.terminate()
+    timer.done('submit')
+    if args.timings:
+        timer.report()
 
 
 CLUSTERS = {'local': Local,
@@ -498,7 +2047,15 @@ IPS = {
 
 
 if __name__ == '__main__':
-    if 'on_exit' in sys.argv:
+    if not DATA_DIR:
+        sys.exit('Set $MEMO to the folder where runs are kept')
+    if sys.argv[1:2] == ['queue']:
+        queue_main(sys.argv[2:])
+    elif sys.argv[1:2] == ['gc']:
+        print('removed', SourceStore().gc(), 'unused source objects')
+    elif sys.argv[1:2] == ['track']:  # memo track <memo_dir> -- <command>
+        sys.exit(track(sys.argv[2], sys.argv[4:]))
+    elif 'on_exit' in sys.argv:
         idx = sys.argv.index('on_exit')
         on_exit(sys.argv[idx + 1])
     elif 'watch_and_sync' in sys.argv:
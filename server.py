@@ -1,10 +1,12 @@
 #!/usr/bin/env python
-import os, datetime, json, pprint, pickle, base64, subprocess, argparse, copy
+import os, datetime, json, pprint, pickle, base64, subprocess, argparse, copy, shutil
+import sqlite3, threading, shlex, glob, fnmatch, array, collections, time
+import concurrent.futures, concurrent.futures.process, urllib.parse, multiprocessing
 
 import numpy as np
 import pandas
 
-import flask
+import flask, markupsafe
 from flask import Flask, request, jsonify, render_template
 import flask_socketio
 
@@ -16,32 +18,419 @@ import watchdog.events
 from bokeh.embed import server_document, components
 from bokeh.layouts import gridplot, widgetbox, row, column
 from bokeh.plotting import figure, curdoc
-from bokeh.models import ColumnDataSource, ColorBar, PrintfTickFormatter, HoverTool, Range1d, LinearColorMapper, FuncTickFormatter
+from bokeh.models import CustomJS, ColumnDataSource, ColorBar, PrintfTickFormatter, HoverTool, Range1d, LinearColorMapper, FuncTickFormatter
 from bokeh.models.glyphs import Image
 from bokeh.palettes import Category10
 from bokeh.models.widgets import Select, Button
 import bokeh.resources
 
+try:
+    from PIL import Image as PILImage
+except ImportError:  # thumbnails fall back to the full images
+    PILImage = None
+try:
+    import gunicorn.app.base
+except ImportError:  # served by Werkzeug's development server instead
+    gunicorn = None
+
+import memo
+
 
 MEMO_PATH = os.environ['MEMO']
-NRECS = 30  # how many records to display when not filtered
+INDEX_PATH = os.path.join(MEMO_PATH, '.index.sqlite')  # persistent run index
+NRECS = 100  # rows of the run table sent per page
 CURRENT_REC_MAX_IDX = None  # stores the last index of the added folder
+LIVE_DELAY = 1  # seconds to wait for more writes before pushing new metrics
+EVENT_DELAY = .5  # seconds a run folder must be quiet before its row is updated
+META_TIMEOUT = 60  # seconds to wait for the meta.json of a new folder
+ACTIVE_POLL = 5  # seconds between checks of meta.json of unfinished runs
+ACTIVE_MAX_AGE = 7 * 24 * 3600  # older unfinished runs are assumed dead
+JOB_POLL = 300  # seconds between asking schedulers about jobs of unfinished runs
+JOB_STALE = 5 * memo.STATS_INTERVAL  # running jobs refresh meta.json more often
+COMPARE_WORKERS = 8  # runs loaded in parallel when comparing
+VIEW_BYTES = 256 * 1024  # larger text files are shown as a tail, loaded by range
+IMAGE_EXTS = ['png', 'jpg', 'jpeg', 'gif', 'tif', 'tiff', 'bmp']
+IMAGE_MAX_AGE = 5 * 60  # seconds browsers may use images before revalidating
+SERVER_THREADS = 100  # connections served at once by gunicorn, each in its own thread
+THUMB_PATH = os.path.join(MEMO_PATH, '.thumbs')  # generated thumbnails
+THUMB_SIZE = (200, 200)
 FILTER_COLUMNS = ['script', 'script args', 'tag', 'description', 'outcome', 'git commit', 'github url']
+# written by `memo track` while a job runs, the numeric ones can be sorted by
+RESOURCE_COLUMNS = ['job state', 'queue wait', 'wall time', 'cpu time', 'peak rss']
+SORT_COLUMNS = ['queue wait', 'wall time', 'cpu time', 'peak rss']
+TABLE_COLUMNS = FILTER_COLUMNS + RESOURCE_COLUMNS
+# search field name -> meta.json key
+SEARCH_FIELDS = {'id': 'id', 'script': 'script', 'args': 'script args', 'tag': 'tag',
+                 'description': 'description', 'outcome': 'outcome', 'commit': 'git commit'}
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-p', '--port', default='5000', type=int)
+parser.add_argument('--line_points', default=1000, type=int,
+                    help='Maximum number of points sent per plotted line')
+parser.add_argument('--plot_cache', default=512, type=int,
+                    help='Memory (in MB) for keeping plots of recently viewed runs')
+parser.add_argument('--workers', default=4, type=int,
+                    help='Threads preparing tables and plots; other requests '
+                         'and live updates are served while they work')
+parser.add_argument('--plot_workers', default=min(4, os.cpu_count() or 1), type=int,
+                    help='Processes reading and aggregating results for plots')
+parser.add_argument('--debug', action='store_true',
+                    help='Development server with the reloader and debugger')
 args = parser.parse_args()
 
 app = Flask(__name__)
 pandas.set_option('display.max_colwidth', -1)
-socketio = flask_socketio.SocketIO(app)
+# the watchers, live update timers and the index all use real threads, so
+# keep that mode even if eventlet or gevent happen to be installed
+socketio = flask_socketio.SocketIO(app, async_mode='threading')
+WORKERS = concurrent.futures.ThreadPoolExecutor(args.workers)
+PLOT_JOBS = {}  # job name from the browser -> (memo_id, future of its waiting plot job)
+PENDING_PLOTS = {}  # memo_id -> future of a Plot being created
+WAITING = collections.Counter()  # memo_id -> requests waiting for its Plot
+PLOT_JOBS_LOCK = threading.Lock()
+# jobs wait here for a free plot process rather than in the pool, which hands
+# them to its processes right away, where they can no longer be cancelled
+PLOT_SLOTS = threading.Condition(PLOT_JOBS_LOCK)
+plot_running = 0  # jobs handed to the plot process pool
+SUBSCRIBERS = {}  # memo_id -> socket ids of clients following its metrics
+LIVE_WATCHES = {}  # memo_id -> watchdog watch of its run folder
+
+
+class PlotCache(object):
+    """
+    LRU cache of Plots (and their rendered html) bounded by memory
+
+    Plots of runs followed by some browser are never evicted, since their
+    state must stay in sync with what these browsers show.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.plots = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, memo_id):
+        with self.lock:
+            pp = self.plots.get(memo_id)
+            if pp is not None:
+                self.plots.move_to_end(memo_id)
+            return pp
+
+    def put(self, memo_id, pp):
+        with self.lock:
+            self.plots[memo_id] = pp
+            self.plots.move_to_end(memo_id)
+
+    def pop(self, memo_id):
+        with self.lock:
+            return self.plots.pop(memo_id, None)
+
+    def shrink(self):
+        """
+        Evict least recently used Plots until the cache fits in memory
+        """
+        with self.lock:
+            total = sum(pp.nbytes() for pp in self.plots.values())
+            for memo_id in list(self.plots):
+                if total <= self.max_bytes:
+                    break
+                if memo_id not in SUBSCRIBERS:
+                    total -= self.plots.pop(memo_id).nbytes()
+
+
+# CustomJS run when a line plot's x-range changes: after a pause in zooming or
+# panning, asks the server for the visible part of each line at full detail
+LINE_RANGE_JS = """
+var range = cb_obj;
+clearTimeout(range.memo_timeout);
+range.memo_timeout = setTimeout(function() {
+    $.post('/plot-range',
+           {data: JSON.stringify([memo_id, col, range.start, range.end])},
+           function(lines) {
+               for (var i = 0; i < hues.length; i++) {
+                   if (hues[i] in lines) {
+                       sources[i].data = lines[hues[i]];
+                   }
+               }
+           });
+}, 300);
+"""
+
+
+def downsample(x, y, npoints):
+    """
+    Downsample a line to `npoints` using Largest-Triangle-Three-Buckets
+
+    Keeps the first and last points and, from every bucket in between, the
+    point forming the largest triangle with the previously kept point and the
+    mean of the next bucket, which preserves peaks and the overall shape.
+    """
+    idx = _lttb_indices(x, y, npoints)
+    if idx is None:
+        return x, y
+    return np.asarray(x)[idx], np.asarray(y)[idx]
+
+
+def _lttb_indices(x, y, npoints):
+    # indices of the points kept by `downsample` or None if all are kept
+    n = len(x)
+    if npoints < 3 or n <= npoints:
+        return None
+    xf = np.asarray(x, dtype=float)
+    yf = np.asarray(y, dtype=float)
+    edges = np.linspace(1, n - 1, npoints - 1).astype(int)
+    idx = np.empty(npoints, dtype=int)
+    idx[0] = 0
+    idx[-1] = n - 1
+    a = 0
+    for i in range(npoints - 2):
+        start, end = edges[i], edges[i + 1]
+        nend = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = xf[end:nend].mean()
+        avg_y = np.nanmean(yf[end:nend]) if np.isfinite(yf[end:nend]).any() else yf[a]
+        area = np.abs((xf[a] - avg_x) * (yf[start:end] - yf[a]) -
+                      (xf[a] - xf[start:end]) * (avg_y - yf[a]))
+        a = start + np.argmax(np.nan_to_num(area, nan=-1))
+        idx[i + 1] = a
+    return idx
+
+
+def bucket_width(n, npoints):
+    """
+    Get the power of two bucket width that `decimate` needs to fit n points in `npoints`
+    """
+    if npoints < 3 or n <= npoints:  # like downsample, fewer means no limit
+        return 1
+    width = 2
+    while 2 * -(-n // width) > npoints:
+        width *= 2
+    return width
+
+
+def decimate(x, y, width):
+    """
+    Keep the lowest and highest point of every `width` consecutive points
+
+    Unlike `downsample`, a bucket only depends on its own points, so a line
+    that grows gets new points at its end while the others stay as they are.
+    An incomplete last bucket is left out.
+    """
+    if width <= 1:
+        return x, y
+    n = len(x) // width * width
+    yb = np.asarray(y[:n], dtype=float).reshape(-1, width)
+    lo = np.argmin(np.where(np.isnan(yb), np.inf, yb), axis=1)
+    hi = np.argmax(np.where(np.isnan(yb), -np.inf, yb), axis=1)
+    idx = np.sort(np.stack([lo, hi], axis=1), axis=1) + np.arange(0, n, width)[:, None]
+    idx = idx.ravel()
+    return np.asarray(x)[idx], np.asarray(y)[idx]
+
+
+class _Codes(dict):
+    """
+    Maps labels to consecutive integer codes in order of appearance
+    """
+
+    def code(self, label):
+        try:
+            return self[label]
+        except KeyError:
+            self[label] = len(self)
+            return self[label]
+
+    def categorical(self, codes):
+        """
+        Build a Categorical from codes, with categories sorted when possible
+        """
+        labels = list(self)
+        try:
+            order = sorted(range(len(labels)), key=labels.__getitem__)
+        except TypeError:  # labels of mixed types
+            order = list(range(len(labels)))
+        remap = np.empty(len(order), dtype=np.int64)
+        remap[order] = np.arange(len(order))
+        codes = np.frombuffer(codes, dtype=codes.typecode)
+        return pandas.Categorical.from_codes(remap[codes],
+                                             categories=[labels[j] for j in order])
+
+
+def flatten(data):
+    """
+    Flatten result records into a long-format DataFrame
+
+    Every scalar becomes a row with categorical `col` and `hue`, a float
+    `value` and one column per key in the record's `meta` (e.g. step, epoch,
+    group). Rows are accumulated as typed arrays: dicts of plain numbers are
+    added in bulk using label codes cached per dict layout, and meta columns
+    are only expanded to row length once at the end.
+    """
+    cols, hues = _Codes(), _Codes()
+    col_codes = array.array('l')
+    hue_codes = array.array('l')
+    values = array.array('d')
+    rec_idx = array.array('l')
+    layouts = {}
+    meta = {}
+
+    def add(i, hue, col, value):
+        if isinstance(value, bytes):  # images are not plotted
+            return
+        try:
+            value = np.nan if value is None else float(value)
+        except (TypeError, ValueError):
+            return
+        hue_codes.append(hues.code(hue))
+        col_codes.append(cols.code(col))
+        values.append(value)
+        rec_idx.append(i)
+
+    def add_dict(i, d, hue=None, col=None):
+        # dict keys are cols when hue is given and hues when col is given;
+        # returns False if some values are not plain numbers
+        layout = (hue, col, tuple(d))
+        try:
+            h, c = layouts[layout]
+        except KeyError:
+            if col is None:
+                h = array.array('l', [hues.code(hue)] * len(d))
+                c = array.array('l', [cols.code(k) for k in d])
+            else:
+                h = array.array('l', [hues.code(k) for k in d])
+                c = array.array('l', [cols.code(col)] * len(d))
+            layouts[layout] = h, c
+        try:
+            values.fromlist(list(d.values()))
+        except TypeError:  # array is left unchanged
+            return False
+        hue_codes.extend(h)
+        col_codes.extend(c)
+        rec_idx.extend(array.array('l', [i]) * len(d))
+        return True
+
+    for i, rec in enumerate(data):
+        for key, value in rec['meta'].items():
+            if key not in meta:
+                meta[key] = [None] * len(data)
+            meta[key][i] = value
+        for key, value in rec.items():
+            if key == 'meta':
+                continue
+            if isinstance(value, dict):
+                if add_dict(i, value, hue=key):
+                    continue
+                for k, v in value.items():
+                    if isinstance(v, dict):
+                        if not add_dict(i, v, col=k):
+                            for ki, vi in v.items():
+                                add(i, ki, k, vi)
+                    else:
+                        add(i, key, k, v)
+            elif isinstance(value, list):
+                add(i, key, 'dur', value[0]['dur'])
+                other_keys = set(value[0].keys()) - set(['kind', 'dur', 'col', 'value'])
+                # entries without other keys have no hue and never get plotted
+                if len(other_keys) > 0:
+                    for val in value:
+                        hue = ' '.join([str(val[o]) for o in other_keys
+                                        if not isinstance(val[o], float)])
+                        add(i, hue, val['target'], val['value'])
+
+    rec_idx = np.frombuffer(rec_idx, dtype=rec_idx.typecode)
+    df = pandas.DataFrame({key: pandas.Series(vals).values[rec_idx]
+                           for key, vals in meta.items()})
+    df['hue'] = hues.categorical(hue_codes)
+    df['col'] = cols.categorical(col_codes)
+    df['value'] = np.frombuffer(values, dtype=values.typecode)
+    return df
 
 
-class Plot(object):
+class ResultsReader(object):
+    """
+    Incrementally reads and aggregates the results of a run
+
+    Only holds what has been read so far, so that it can be sent to the plot
+    process pool and back.
+    """
 
     def __init__(self, memo_id):
+        self.memo_id = memo_id
+        self.nrecs = 0
+        self.pkl_nrecs = 0
+        self.pkl_stat = None
+        self.offsets = {}  # results stream segment -> bytes already read
+        self.xaxis = None
+
+    def get_records(self):
+        """
+        Read records that have been added since the last call
+
+        Results streams are read from the stored offsets on; a legacy
+        results.pkl is only re-read when its size or mtime changes.
+        """
+        data = []
+        path = os.path.join(MEMO_PATH, self.memo_id, 'results.pkl')
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            if (stat.st_size, stat.st_mtime) != self.pkl_stat:
+                self.pkl_stat = (stat.st_size, stat.st_mtime)
+                recs = pandas.read_pickle(path)
+                data.extend(recs[self.pkl_nrecs:])
+                self.pkl_nrecs = len(recs)
+
+        pattern = os.path.join(MEMO_PATH, self.memo_id, memo.RESULTS_PATTERN)
+        for path in sorted(glob.glob(pattern)):
+            offset = self.offsets.get(path, 0)
+            if os.path.getsize(path) > offset:
+                recs, self.offsets[path] = memo.read_records(path, offset)
+                data.extend(recs)
+        return data
+
+    def get_data(self):
+        data = self.get_records()
+        df = flatten(data)
+        self.nrecs += len(data)
+        return df
+
+    def get_agg(self):
+        df = self.get_data()
+        if len(df) > 0 or self.xaxis is None:  # keep it for empty updates
+            if 'step' in df.columns:
+                self.xaxis = 'step'
+            else:
+                self.xaxis = 'epoch'
+
+        if len(df) > 0:
+            if 'group' in df:
+                keys = ['col', 'hue', 'group', self.xaxis]
+            else:
+                keys = ['col', 'hue', self.xaxis]
+            agg = df.groupby(keys, observed=True).value.mean().sort_index()
+            agg.index = agg.index.remove_unused_levels()
+            # ims = df[sel & (df[sel].step == df[sel].step.max())].value.values
+            ims = None
+        else:
+            agg = None
+            ims = None
+        return agg, ims
+
+
+def read_agg(reader):
+    # runs in the plot process pool
+    agg, ims = reader.get_agg()
+    return reader, agg, ims
+
+
+class Plot(object):
+
+    def __init__(self, memo_id, npoints=None, job=None):
         self.memo_id = str(memo_id)
+        self.npoints = args.line_points if npoints is None else npoints
+        self.lines = {}  # (col, hue) -> full resolution x and y
+        self.shown = {}  # (col, hue) -> bucket width and number of points in its source
         self.nrecs = 0
+        self.lock = threading.Lock()
+        self.rendered = None  # (results files signature, html)
+        self.reader = ResultsReader(self.memo_id)
         self.timestamp = datetime.datetime(datetime.MINYEAR, 1, 1)
 
         # memo_ids = sorted(os.listdir(MEMO_PATH))[::-1]
@@ -57,7 +446,7 @@ class Plot(object):
         # curdoc().add_periodic_callback(self.update_widgets, 6000)
         # curdoc().title = 'tensorplay'
 
-        agg = self.make_plots()
+        agg = self.make_plots(job)
         self.update_plots(agg)
 
     # def change_id(self, attr, old, new):
@@ -69,78 +458,16 @@ class Plot(object):
     # def update_widgets(self):
     #     self.widgetbox['id'].options = sorted(os.listdir(MEMO_PATH))[::-1]
 
-    def get_data(self):
-        df = []
-        path = os.path.join(MEMO_PATH, self.memo_id, 'results.pkl')
-        if not os.path.isfile(path):
-            return df
-
-        data = pandas.read_pickle(path)
-        for rec in data[self.nrecs:]:
-            common = list(rec['meta'].items())  # [('step', step)]
-            # for key, value in rec.items():
-            #     if not isinstance(value, (dict, list)) and key != '_id':
-            #         common.append((key, value))
-            # import ipdb; ipdb.set_trace()
-            for key, value in rec.items():
-                if key != 'meta':
-                    if isinstance(value, dict):
-                        for k, v in value.items():
-                            # import ipdb; ipdb.set_trace()
-                            # if k == 'meta': import ipdb; ipdb.set_trace()
-                            if isinstance(v, dict):
-                                for ki, vi in v.items():
-                                    df.append(dict(common + [('hue', ki), ('col', k), ('value', vi)]))
-                            # elif isinstance(v, bytes):  # image
-                            #     import ipdb; ipdb.set_trace()
-
-                            else:
-                                df.append(dict(common + [('hue', key), ('col', k), ('value', v)]))
-                    elif isinstance(value, list):
-                        r = {'hue': key,
-                            'col': 'dur',
-                            'value': value[0]['dur']}
-                        r.update(common)
-                        tmp = [r]
-                        other_keys = set(value[0].keys()) - set(['kind', 'dur', 'col', 'value'])
-                        for val in value:
-                            if len(other_keys) > 0:
-                                r = {'hue': ' '.join([str(val[o]) for o in other_keys if not isinstance(val[o], float)]),
-                                    'col': val['target'],
-                                    'value': val['value']}
-                            else:
-                                r = val.copy()
-                            r.update(common)
-                            tmp.append(r)
-                        df.extend(tmp)
-        df = pandas.DataFrame(df)
-        self.nrecs = len(data)
-        return df
-
-    def get_agg(self):
-        df = self.get_data()
-        if 'step' in df.columns:
-            self.xaxis = 'step'
-        else:
-            self.xaxis = 'epoch'
-
-        if len(df) > 0:
-            sel = df['value'].apply(lambda x: isinstance(x, bytes))
-            sdf = df[~sel]
-            sdf.value = sdf.value.astype(float)
-            if 'group' in df:
-                agg = sdf.groupby(['col', 'hue', 'group', self.xaxis]).value.mean()
-            else:
-                agg = sdf.groupby(['col', 'hue', self.xaxis]).value.mean()
-            # ims = df[sel & (df[sel].step == df[sel].step.max())].value.values
-            ims = None
-        else:
-            agg = None
-            ims = None
+    def get_agg(self, job=None):
+        # reading and aggregating is CPU-bound, so it happens in the plot
+        # process pool; the read state comes back with the result
+        self.reader, agg, ims = run_plot_job(self.memo_id, job, read_agg, self.reader)
+        self.nrecs = self.reader.nrecs
+        self.xaxis = self.reader.xaxis
         return agg, ims
 
-    def make_plots(self):
-        agg, ims = self.get_agg()
+    def make_plots(self, job=None):
+        agg, ims = self.get_agg(job)
         plots = []
         sources = {}
 
@@ -188,11 +515,19 @@ class Plot(object):
 
             else:
                 for i, hue in enumerate(uq_hue):
-                    sources[col][hue] = ColumnDataSource({self.xaxis: [], col:[]})
+                    # named so that live updates can find them in the browser
+                    sources[col][hue] = ColumnDataSource({self.xaxis: [], col:[]},
+                                                         name=f'{self.memo_id}|{col}|{hue}')
                     p.line(x=self.xaxis, y=col, color=Category10[10][i], legend=str(hue),
                         source=sources[col][hue])
                 p.legend.location = 'bottom_left'
                 p.legend.background_fill_alpha = 0
+                # fetch a finer downsampling of the visible part after zooming
+                p.x_range.js_on_change('end', CustomJS(
+                    args={'memo_id': self.memo_id, 'col': str(col),
+                          'hues': [str(hue) for hue in uq_hue],
+                          'sources': list(sources[col].values())},
+                    code=LINE_RANGE_JS))
 
             plots.append(p)
         # import ipdb; ipdb.set_trace()
@@ -207,11 +542,22 @@ class Plot(object):
         self.sources = sources
         return agg, ims
 
-    def update_plots(self, agg=None):
+    def update_plots(self, agg=None, job=None):
+        """
+        Update plot sources and return the new points of every line
+
+        New points are returned as {col: {hue: {xaxis: [...], col: [...]}}},
+        ready to be streamed to the browser. Lines longer than `npoints` are
+        decimated with a bucket width that doubles as they grow, so new points
+        come decimated as well and the newest, incomplete bucket waits until
+        it is full. Only when the width changes is the whole decimated line
+        returned, under {'replace': True}, for the browser to swap in.
+        """
         if agg is None:
-            agg, ims = self.get_agg()
+            agg, ims = self.get_agg(job)
         else:
             agg, ims = agg
+        new_points = {}
         if agg is not None:
             for col in self.sources:
                 if not isinstance(self.sources[col], dict):
@@ -254,18 +600,31 @@ class Plot(object):
                     for hue in self.sources[col]:
                         try:
                             if 'group' in agg.loc[(col, hue)].index.names:
-                                new_data = {self.xaxis: agg.loc[(col, hue, 0)].index,
-                                            col: agg.loc[(col, hue, 0)]}
-                                # import ipdb; ipdb.set_trace()
-                                self.sources[col][hue].stream(new_data)
+                                line = agg.loc[(col, hue, 0)]
                             else:
-                                new_data = {self.xaxis: agg.loc[(col, hue)].index,
-                                            col: agg.loc[(col, hue)]}
-                                # import ipdb; ipdb.set_trace()
-                                self.sources[col][hue].stream(new_data)
+                                line = agg.loc[(col, hue)]
                         except:  # because not all updates have all cols
                             # import ipdb; ipdb.set_trace()
-                            pass
+                            continue
+                        x, y = line.index.values, line.values
+                        if (col, hue) in self.lines:
+                            x = np.concatenate([self.lines[(col, hue)][0], x])
+                            y = np.concatenate([self.lines[(col, hue)][1], y])
+                        self.lines[(col, hue)] = x, y
+                        width = bucket_width(len(x), self.npoints)
+                        x, y = decimate(x, y, width)
+                        self.sources[col][hue].data = {self.xaxis: x, col: y}
+                        shown_width, shown = self.shown.get((col, hue), (None, 0))
+                        self.shown[(col, hue)] = width, len(x)
+                        replace = width != shown_width
+                        if not replace:
+                            x, y = x[shown:], y[shown:]
+                            if len(x) == 0:
+                                continue
+                        new_points.setdefault(str(col), {})[str(hue)] = {
+                            'replace': replace,
+                            self.xaxis: x.tolist(),
+                            col: np.where(np.isnan(y), None, y).tolist()}
             # self.nrecs = len(agg)
 
         if ims is not None:
@@ -287,25 +646,62 @@ class Plot(object):
             # plt.imshow(new_data['data'][0])
             # plt.show()
             self.sources['ims'].stream(new_data)# = new_data
+        return new_points
+
+    def nbytes(self):
+        """
+        Rough memory footprint, used to bound the plot cache
+        """
+        n = sum(x.nbytes + y.nbytes for x, y in self.lines.values())
+        if self.rendered is not None:
+            n += len(self.rendered[1])
+        return n
+
+    def get_line_range(self, col, start, end):
+        """
+        Downsample every line of a plot within an x-range
+
+        One point beyond each side of the range is kept so that lines run
+        off the edges of the plot.
+        """
+        lines = {}
+        for (c, hue), (x, y) in self.lines.items():
+            if str(c) != col:
+                continue
+            lo = max(np.searchsorted(x, start) - 1, 0)
+            hi = np.searchsorted(x, end, side='right') + 1
+            x_, y_ = downsample(x[lo:hi], y[lo:hi], self.npoints)
+            y_ = np.where(np.isnan(y_), None, y_)  # NaN is not valid JSON
+            lines[str(hue)] = {self.xaxis: x_.tolist(), col: y_.tolist()}
+        return lines
+
+
+def offload(func, *params):
+    """
+    Run blocking work (index queries, plot data) in the worker pool
+
+    Each request has its own thread that just waits for the result, so at
+    most --workers requests compete for the CPU while the rest, e.g. Socket.IO
+    polling and static files, keep being answered.
+    """
+    return WORKERS.submit(func, *params).result()
 
 
 @app.route('/', methods=['GET'])
 def index():
-    df = get_table(nrecs=NRECS)
-    table = format_table(df)
     template = render_template('index.html',
-                               table=table,
+                               page=offload(get_page),
                                resources=bokeh.resources.CDN.render(),
                                async_mode=socketio.async_mode)
     return template
 
 
-@app.route('/memo/<id_>/<path>', methods=['GET'])
+@app.route('/memo/<id_>/<path:path>', methods=['GET'])
 def all_routes(id_, path):
     # import ipdb; ipdb.set_trace()
     # ext = os.path.splitext(path)[-1][1:].lower()
     # data = open(os.path.join(os.environ['MEMO'], id_, path)).read()
-    return flask.send_file(os.path.join(os.environ['MEMO'], id_, path))
+    return send_run_file(id_, path)
     # data = open(fullpath).read()
     # if ext == 'html':
     #     with open(os.path.join(os.environ['MEMO'], path)) as f:
@@ -331,20 +727,80 @@ def all_routes2(id_, path):
     # import ipdb; ipdb.set_trace()
     # ext = os.path.splitext(path)[-1][1:].lower()
     # data = open(os.path.join(os.environ['MEMO'], id_, path)).read()
-    return flask.send_file(os.path.join(os.environ['MEMO'], id_, 'images', path))
+    return send_run_file(id_, os.path.join('images', path))
+
+
+@app.route('/thumbs/<id_>/<path:path>', methods=['GET'])
+def thumbnail(id_, path):
+    src = run_path(id_, path)
+    thumb = get_thumbnail(src, os.path.join(THUMB_PATH, id_, path + '.png'))
+    return flask.send_file(thumb, conditional=True, max_age=IMAGE_MAX_AGE)
+
+
+def run_path(id_, path):
+    # full path of a file in a run folder, refusing anything outside of it
+    root = os.path.normpath(os.path.join(MEMO_PATH, id_))
+    full = os.path.normpath(os.path.join(root, path))
+    if os.path.dirname(root) != os.path.normpath(MEMO_PATH) or \
+            not full.startswith(root + os.sep):
+        flask.abort(404)
+    return full
+
 
+def send_run_file(id_, path):
+    """
+    Send a file of a run with Range and conditional request support
 
-def get_table(nrecs=None, filter_columns=True):
+    Images may be reused by browsers for IMAGE_MAX_AGE; other files, e.g.
+    logs that keep growing, are revalidated (ETag/Last-Modified) every time.
+    Range requests are answered by seeking, so the tail of a huge log can be
+    read without loading it.
+    """
+    ext = os.path.splitext(path)[-1][1:].lower()
+    max_age = IMAGE_MAX_AGE if ext in IMAGE_EXTS else 0
+    return flask.send_file(run_path(id_, path), conditional=True, max_age=max_age)
+
+
+def get_thumbnail(src, dst):
+    """
+    Path of a thumbnail of the image `src`, (re)generated at `dst` if stale
+
+    Without Pillow, or if the image cannot be read, the image itself is used.
+    """
+    if PILImage is None:
+        return src
+    try:
+        if os.path.getmtime(dst) >= os.path.getmtime(src):
+            return dst
+    except OSError:
+        pass
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = f'{dst}.{threading.get_ident()}.tmp'
+    try:
+        with PILImage.open(src) as im:
+            im.thumbnail(THUMB_SIZE)
+            if im.mode not in ['1', 'L', 'LA', 'P', 'RGB', 'RGBA']:
+                im = im.convert('RGB')
+            im.save(tmp, 'PNG')
+    except OSError as err:
+        print(f'Cannot make a thumbnail of {src} ({err})')
+        return src
+    os.replace(tmp, dst)
+    return dst
+
+
+def get_table(nrecs=None, filter_columns=True, search=None, offset=0,
+              cursor=None, ascending=False, sort=None):
     global CURRENT_REC_MAX_IDX
-    df = []
-    for folder in sorted(os.listdir(os.environ['MEMO'])):
-        data = _read_rec(folder)
-        if data is not None:
-            df.append(data)
-    df = pandas.DataFrame(df)
-    df = df[::-1]
-    nrecs = len(df) if nrecs is None else nrecs
-    df = df[:nrecs]
+    if search:
+        recs = INDEX.search(search, limit=nrecs, offset=offset,
+                            cursor=cursor, ascending=ascending, sort=sort)
+    else:
+        recs = INDEX.get(nrecs=nrecs, offset=offset,
+                         cursor=cursor, ascending=ascending, sort=sort)
+    df = pandas.DataFrame(recs)
+    if len(df) == 0:
+        df = pandas.DataFrame(columns=['id'] + TABLE_COLUMNS)
     df['git commit'] = None
     df['github url'] = None
     # if len(df) < nrecs:
@@ -359,15 +815,292 @@ def get_table(nrecs=None, filter_columns=True):
 
     df = df.set_index('id')
     if filter_columns:
-        df = df[FILTER_COLUMNS]
-    CURRENT_REC_MAX_IDX = df.index[0]
+        # runs launched before resources were tracked have no such fields
+        df = df.reindex(columns=TABLE_COLUMNS)
+    if len(df) > 0 and offset == 0 and cursor is None and not ascending and sort is None:
+        CURRENT_REC_MAX_IDX = df.index[0]
     return df
 
 
+def table_rows(df):
+    # [memo_id, value per column] with missing values as None for JSON
+    df = df.astype(object).where(df.notnull(), None)
+    return [[id_] + list(values) for id_, values in zip(df.index, df.values.tolist())]
+
+
+def get_page(search='', cursor=None, ascending=False, sort=None):
+    """
+    A page of the run table sorted by memo_id, or by one of SORT_COLUMNS
+
+    `next` is the cursor for the following page (None at the end) and
+    `total` the number of matching runs, only counted for the first page.
+    Pages sorted by memo_id continue after the last id, other sorts use the
+    number of rows sent so far as the cursor.
+    """
+    if sort not in SORT_COLUMNS:
+        sort = None
+    if sort is None:
+        df = get_table(nrecs=NRECS, search=search, cursor=cursor, ascending=ascending)
+    else:
+        df = get_table(nrecs=NRECS, search=search, offset=cursor or 0,
+                       ascending=ascending, sort=sort)
+    rows = table_rows(df)
+    if len(rows) < NRECS:
+        next_cursor = None
+    elif sort is None:
+        next_cursor = rows[-1][0]
+    else:
+        next_cursor = (cursor or 0) + len(rows)
+    page = {'columns': TABLE_COLUMNS, 'rows': rows, 'next': next_cursor}
+    if cursor is None:
+        page['total'] = INDEX.count(search)
+    return page
+
+
+class Index(object):
+    """
+    Persistent SQLite index of run records keyed by memo_id
+
+    Each row stores the record as returned by `_read_rec` together with the
+    mtime of its meta.json, so that rebuilds only re-read changed folders.
+    Searchable fields are mirrored into a full-text table that shares rowids
+    with `runs`.
+    """
+
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS runs '
+                              '(id TEXT PRIMARY KEY, mtime REAL, data TEXT)')
+            exists = self.conn.execute("SELECT 1 FROM sqlite_master "
+                                       "WHERE name = 'search'").fetchone()
+            columns = ', '.join(f'"{f}"' for f in SEARCH_FIELDS)
+            try:
+                self.conn.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS search '
+                                  f"USING fts5({columns}, tokenize='trigram')")
+                self.trigram = True
+            except sqlite3.OperationalError:  # no FTS5 or trigram tokenizer
+                self.conn.execute(f'CREATE TABLE IF NOT EXISTS search ({columns})')
+                self.trigram = False
+            else:
+                # an existing fallback table from an older sqlite stays as is
+                sql = self.conn.execute("SELECT sql FROM sqlite_master "
+                                        "WHERE name = 'search'").fetchone()[0]
+                self.trigram = 'fts5' in sql.lower()
+            if not exists:  # search table is new, so force a full rebuild
+                self.conn.execute('DELETE FROM runs')
+
+    def _row(self, folder):
+        mtime = _meta_mtime(folder)
+        if mtime is None:
+            return None
+        try:
+            data = _read_rec(folder)
+        except ValueError:  # meta.json is still being written
+            return None
+        if data is not None:
+            data['job state'] = job_state(folder, data, mtime)
+        return folder, mtime, data
+
+    def _upsert(self, folder, mtime, data):
+        fields = [str(data.get(key) or '') for key in SEARCH_FIELDS.values()]
+        row = self.conn.execute('SELECT rowid FROM runs WHERE id = ?',
+                                (folder,)).fetchone()
+        if row is None:
+            rowid = self.conn.execute('INSERT INTO runs VALUES (?, ?, ?)',
+                                      (folder, mtime, json.dumps(data))).lastrowid
+        else:
+            rowid = row[0]
+            self.conn.execute('UPDATE runs SET mtime = ?, data = ? WHERE rowid = ?',
+                              (mtime, json.dumps(data), rowid))
+            self.conn.execute('DELETE FROM search WHERE rowid = ?', (rowid,))
+        columns = ', '.join(f'"{f}"' for f in SEARCH_FIELDS)
+        marks = ', '.join(['?'] * len(fields))
+        self.conn.execute(f'INSERT INTO search (rowid, {columns}) VALUES (?, {marks})',
+                          [rowid] + fields)
+
+    def _delete(self, folder):
+        row = self.conn.execute('SELECT rowid FROM runs WHERE id = ?',
+                                (folder,)).fetchone()
+        if row is not None:
+            self.conn.execute('DELETE FROM search WHERE rowid = ?', row)
+            self.conn.execute('DELETE FROM runs WHERE rowid = ?', row)
+
+    def update(self, folder):
+        """
+        (Re-)index a single run folder or drop it if it is gone
+
+        Returns the record or None if there is no readable meta.json.
+        """
+        row = self._row(folder)
+        with self.lock, self.conn:
+            if row is None:
+                self._delete(folder)
+            else:
+                self._upsert(*row)
+        return None if row is None else row[2]
+
+    def remove(self, folder):
+        with self.lock, self.conn:
+            self._delete(folder)
+
+    def sync(self):
+        """
+        Bring the index up to date with the folders in MEMO_PATH
+
+        Only folders whose meta.json mtime changed since the last sync are read.
+        """
+        with self.lock:
+            indexed = dict(self.conn.execute('SELECT id, mtime FROM runs'))
+        folders = set(os.listdir(MEMO_PATH))
+        rows = []
+        for folder in folders:
+            mtime = _meta_mtime(folder)
+            if mtime is not None and indexed.get(folder) != mtime:
+                row = self._row(folder)
+                if row is not None:
+                    rows.append(row)
+        with self.lock, self.conn:
+            for row in rows:
+                self._upsert(*row)
+            for folder in indexed:
+                if folder not in folders:
+                    self._delete(folder)
+
+    def recent(self, since):
+        """
+        Return (id, meta.json mtime, record) of runs changed after `since`
+        """
+        with self.lock:
+            rows = self.conn.execute('SELECT id, mtime, data FROM runs WHERE mtime > ?',
+                                     (since,)).fetchall()
+        return [(folder, mtime, json.loads(data)) for folder, mtime, data in rows]
+
+    def _fetch(self, folder, mtime, data):
+        # cheap check that meta.json has not been rewritten behind our back
+        if _meta_mtime(folder) != mtime:
+            self.update(folder)
+            with self.lock:
+                row = self.conn.execute('SELECT data FROM runs WHERE id = ?',
+                                        (folder,)).fetchone()
+            if row is None:
+                return None
+            data = row[0]
+        return json.loads(data)
+
+    def get(self, nrecs=None, offset=0, cursor=None, ascending=False, sort=None):
+        """
+        Return the newest `nrecs` records (all if None), newest first
+
+        With a `cursor` (a memo_id), only records after it in that order are
+        returned, which pages without the cost of large offsets. With `sort`,
+        records are ordered by that field instead, largest first and those
+        without it last.
+        """
+        return self._query('', [], nrecs, offset, cursor, ascending, sort=sort)
+
+    def search(self, query, limit=None, offset=0, cursor=None, ascending=False,
+               sort=None):
+        """
+        Return records matching a search query, newest first
+
+        The query is split into whitespace-separated terms (quote to keep
+        spaces) that must all match. A term matches if it is a case-insensitive
+        substring of any searchable field, or only of the given field when
+        written as `field:term` (e.g. `tag:foo outcome:diverged`).
+        """
+        where, params = self._where(query)
+        return self._query(' JOIN search ON search.rowid = runs.rowid', where,
+                           limit, offset, cursor, ascending, params, sort)
+
+    def count(self, query=''):
+        """
+        Number of records matching a search query (all if empty)
+        """
+        where, params = self._where(query)
+        sql = 'SELECT COUNT(*) FROM runs'
+        if where:
+            sql += ' JOIN search ON search.rowid = runs.rowid WHERE ' + ' AND '.join(where)
+        with self.lock:
+            return self.conn.execute(sql, params).fetchone()[0]
+
+    def _where(self, query):
+        where = []
+        params = []
+        match = []
+        for term in _split_query(query):
+            field, sep, value = term.partition(':')
+            if sep and field in SEARCH_FIELDS:
+                columns = [field]
+            else:
+                columns = list(SEARCH_FIELDS)
+                value = term
+            if value == '':
+                continue
+            if self.trigram and len(value) >= 3:
+                phrase = '"' + value.replace('"', '""') + '"'
+                if len(columns) == 1:
+                    phrase = f'{columns[0]} : {phrase}'
+                match.append(phrase)
+            else:  # trigram index cannot help, scan the text instead
+                value = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                where.append('(' + ' OR '.join(f"search.\"{c}\" LIKE ? ESCAPE '\\'"
+                                               for c in columns) + ')')
+                params += [f'%{value}%'] * len(columns)
+        if match:
+            where.insert(0, 'search MATCH ?')
+            params.insert(0, ' AND '.join(match))
+        return where, params
+
+    def _query(self, join, where, limit, offset, cursor, ascending, params=(),
+               sort=None):
+        where = list(where)
+        params = list(params)
+        if cursor is not None:
+            where.append('runs.id > ?' if ascending else 'runs.id < ?')
+            params.append(cursor)
+        sql = 'SELECT runs.id, runs.mtime, runs.data FROM runs' + join
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        order = 'ASC' if ascending else 'DESC'
+        if sort is None:
+            sql += f' ORDER BY runs.id {order}'
+        else:  # sort is one of SORT_COLUMNS, never user input
+            key = f"json_extract(runs.data, '$.\"{sort}\"')"
+            sql += f' ORDER BY {key} IS NULL, {key} {order}, runs.id {order}'
+        sql += ' LIMIT ? OFFSET ?'
+        params += [-1 if limit is None else limit, offset]
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        recs = [self._fetch(*row) for row in rows]
+        return [rec for rec in recs if rec is not None]
+
+
+def _split_query(query):
+    try:
+        return shlex.split(query)
+    except ValueError:  # unbalanced quotes while typing
+        return query.split()
+
+
+def _meta_mtime(folder):
+    # the latest change of meta.json or of its edit log
+    try:
+        mtime = os.path.getmtime(os.path.join(MEMO_PATH, folder, 'meta.json'))
+    except OSError:
+        return None
+    try:
+        return max(mtime, os.path.getmtime(os.path.join(MEMO_PATH, folder, memo.EDITS_FILE)))
+    except OSError:
+        return mtime
+
+
 def _read_rec(folder):
     meta_path = os.path.join(os.environ['MEMO'], folder, 'meta.json')
     if os.path.isfile(meta_path):
-        data = json.load(open(meta_path))
+        data = memo.read_meta(os.path.dirname(meta_path))
         key = 'args' if 'args' in data else 'script args'
         if key in data:
             data['script args'] = ' '.join(data[key])
@@ -383,39 +1116,22 @@ def _read_rec(folder):
     return data
 
 
-def format_table(table, return_rows=False):
-    table = table.to_html(index_names=False)
-    table = table.replace('border="1" class="dataframe"', 'class="table"')
-    if return_rows:
-        start = table.find('<tbody>\n') + 9 + 3
-        end = table.find('</tbody>') - 4
-        table = table[start:end]
-    return table
-
-
-@app.route('/search', methods=['POST'])
-def search():
-    print('Received search', datetime.datetime.now().strftime('%H:%M:%S'))
-    search_term = json.loads(request.form['data'])
-    nrecs = NRECS if search_term == '' else None
-    df = get_table(nrecs=nrecs, filter_columns=False)
-    dfi = df.reset_index()
-    dfi = dfi[dfi.apply(lambda col: col.astype(str).str.contains(search_term)).any(axis=1).values]
-    df = dfi.set_index('id')
-    df = df[FILTER_COLUMNS]
-    rows = format_table(df, return_rows=True)
-    print('Sent search', datetime.datetime.now().strftime('%H:%M:%S'))
-    return rows
+@app.route('/rows', methods=['POST'])
+def rows():
+    print('Received rows', datetime.datetime.now().strftime('%H:%M:%S'))
+    query = json.loads(request.form['data'])
+    page = offload(get_page, query.get('search', ''), query.get('cursor'),
+                   query.get('ascending', False), query.get('sort'))
+    print('Sent rows', datetime.datetime.now().strftime('%H:%M:%S'))
+    return jsonify(page)
 
 
 @app.route('/', methods=['POST'])
 def confirm_edit():
     id_, col, value = json.loads(request.form['data'])
-    path = os.path.join(MEMO_PATH, id_, 'meta.json')
-    data = json.load(open(path))
-    data[col] = value
-    with open(path, 'w') as f:
-        json.dump(data, f)
+    memo.append_edit(os.path.join(MEMO_PATH, id_), col, value)
+    INDEX.update(id_)
+    UPDATES.touch(id_)  # for the other browsers
     # time.sleep(10)
     # print(row, col, value)
     # df = pandas.read_csv('index.csv', index_col=0, na_values='NaN', keep_default_na=False)
@@ -434,6 +1150,8 @@ def remove_rows():
         print(err)
         return f'Could not remove this entry ({err})'
     else:
+        INDEX.remove(id_)
+        shutil.rmtree(os.path.join(THUMB_PATH, id_), ignore_errors=True)
         return 'ok'
     # index = int(index[1:])  # first character is x
     # df = pandas.read_csv('index.csv', index_col=0, na_values='NaN', keep_default_na=False)
@@ -466,77 +1184,643 @@ def popup():
 
 @app.route('/click-file', methods=['POST'])
 def click_file():
-    id_, filename = json.loads(request.form['data'])
-    data = render_file(id_, filename)
+    id_, filename, job = json.loads(request.form['data'])
+    try:
+        data = offload(render_file, id_, filename, job)
+    except concurrent.futures.CancelledError:
+        data = ''
     return jsonify(data)
 
 
-def render_file(id_, filename):
+@app.route('/cancel', methods=['POST'])
+def cancel():
+    job = json.loads(request.form['data'])
+    cancel_plot_job(job)
+    return 'ok'
+
+
+@app.route('/plot-range', methods=['POST'])
+def plot_range():
+    id_, col, start, end = json.loads(request.form['data'])
+    lines = offload(line_range, id_, col, start, end)
+    return jsonify(lines)
+
+
+def line_range(id_, col, start, end):
+    pp = PLOTS.get(id_)
+    if pp is None:
+        pp = Plot(id_)
+    with pp.lock:
+        return pp.get_line_range(col, start, end)
+
+
+@app.route('/compare', methods=['POST'])
+def compare():
+    memo_ids = json.loads(request.form['data'])
+    return offload(render_compare, memo_ids)
+
+
+def render_compare(memo_ids):
+    plots = compare_plots(memo_ids)
+    if len(plots) == 0:
+        return 'No results to compare'
+    script, div = components(plots)
+    return script + ''.join(div.values())
+
+
+def _try_get_plot(memo_id):
+    try:
+        return get_plot(memo_id)
+    except Exception as err:  # e.g. no results yet
+        print(f'Cannot compare {memo_id} ({err})')
+        return None
+
+
+def compare_plots(memo_ids):
+    """
+    Overlay the metrics of several runs, e.g. of a sweep
+
+    Runs are loaded in parallel through the plot cache. For every metric and
+    hue, each run is drawn as a thin line and the runs, aligned on their step
+    (or epoch), are summarized by their mean with a band from min to max.
+    """
+    with concurrent.futures.ThreadPoolExecutor(COMPARE_WORKERS) as pool:
+        plots = list(pool.map(_try_get_plot, memo_ids))
+    PLOTS.shrink()
+
+    xaxis = None
+    lines = collections.defaultdict(dict)  # (col, hue) -> {memo_id: Series}
+    for memo_id, pp in zip(memo_ids, plots):
+        if pp is None:
+            continue
+        with pp.lock:
+            if xaxis is None:
+                xaxis = pp.xaxis
+            elif pp.xaxis != xaxis:  # cannot be aligned
+                continue
+            npoints = pp.npoints
+            for (col, hue), (x, y) in pp.lines.items():
+                line = pandas.Series(y, index=x)
+                line = line.groupby(level=0).mean()  # in case steps repeat
+                lines[(str(col), str(hue))][memo_id] = line
+
+    figures = {}
+    hues = collections.defaultdict(list)
+    for (col, hue), runs in sorted(lines.items()):
+        if col not in figures:
+            p = figure(plot_height=300, plot_width=400, title=col,
+                       tools=['save', 'ywheel_zoom', 'pan', 'reset'],
+                       toolbar_location='above', min_border_left=80)
+            p.xaxis.axis_label = xaxis
+            p.yaxis.axis_label = col
+            figures[col] = p
+        p = figures[col]
+        hues[col].append(hue)
+        color = Category10[10][(len(hues[col]) - 1) % 10]
+
+        for line in runs.values():
+            line = line.dropna()
+            x, y = downsample(line.index.values, line.values, npoints)
+            p.line(x=x, y=y, color=color, alpha=.3, line_width=1)
+
+        df = pandas.concat(runs, axis=1).sort_index()
+        mean = df.mean(axis=1)
+        idx = _lttb_indices(df.index.values, mean.values, npoints)
+        if idx is not None:
+            df, mean = df.iloc[idx], mean.iloc[idx]
+        p.varea(x=df.index.values, y1=df.min(axis=1).values,
+                y2=df.max(axis=1).values, color=color, alpha=.2)
+        p.line(x=df.index.values, y=mean.values, color=color, line_width=2,
+               legend=f'{hue} (n={len(runs)})')
+        p.legend.location = 'bottom_left'
+        p.legend.background_fill_alpha = 0
+    return figures
+
+
+def is_results_file(filename):
+    return filename == 'results.pkl' or fnmatch.fnmatch(filename, memo.RESULTS_PATTERN)
+
+
+def results_signature(memo_id):
+    """
+    Names, sizes and mtimes of a run's results files, to detect changes
+    """
+    paths = glob.glob(os.path.join(MEMO_PATH, memo_id, 'results.pkl'))
+    paths += glob.glob(os.path.join(MEMO_PATH, memo_id, memo.RESULTS_PATTERN))
+    sig = []
+    for path in sorted(paths):
+        st = os.stat(path)
+        sig.append((os.path.basename(path), st.st_size, st.st_mtime_ns))
+    return tuple(sig)
+
+
+def get_plot(memo_id, sig=None, job=None):
+    """
+    Get an up to date Plot of a run, from the cache when possible
+
+    If the results files signature `sig` is given and matches what the
+    cached Plot last rendered, the Plot is not even refreshed. Concurrent
+    requests for a run that is not cached yet share a single Plot.
+    """
+    pp = PLOTS.get(memo_id)
+    if pp is not None:
+        if sig is None or pp.rendered is None or pp.rendered[0] != sig:
+            refresh_plot(memo_id, job)
+        return pp
+
+    with PLOT_JOBS_LOCK:
+        future = PENDING_PLOTS.get(memo_id)
+        owner = future is None
+        if owner:
+            future = PENDING_PLOTS[memo_id] = concurrent.futures.Future()
+        WAITING[memo_id] += 1
+    try:
+        if not owner:
+            return future.result()
+        try:
+            pp = Plot(memo_id, job=job)
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        PLOTS.put(memo_id, pp)
+        future.set_result(pp)
+        return pp
+    finally:
+        with PLOT_JOBS_LOCK:
+            WAITING[memo_id] -= 1
+            if WAITING[memo_id] == 0:
+                del WAITING[memo_id]
+            if owner:
+                del PENDING_PLOTS[memo_id]
+
+
+def make_plot_pool():
+    """
+    Start the plot process pool with all its processes
+
+    The processes are forked, so they must all exist before the server starts
+    other threads: a thread holding a lock at fork time leaves it locked for
+    good in the child. Blocking warm-up jobs keep each process busy until all
+    have been started, whether the pool forks them at once or on demand.
+    """
+    pool = concurrent.futures.ProcessPoolExecutor(
+        args.plot_workers, mp_context=multiprocessing.get_context('fork'))
+    for future in [pool.submit(time.sleep, .1) for _ in range(args.plot_workers)]:
+        future.result()
+    return pool
+
+
+def replace_plot_pool(broken):
+    """
+    Replace the plot process pool if it is still the given broken one
+    """
+    global PLOT_POOL
+    with PLOT_JOBS_LOCK:
+        if PLOT_POOL is broken:
+            print('Restarting the plot process pool')
+            broken.shutdown(wait=False)
+            # forked while other threads run, which is the best we can do now
+            PLOT_POOL = make_plot_pool()
+        return PLOT_POOL
+
+
+def run_plot_job(memo_id, job, func, *params):
+    """
+    Run `func` in the plot process pool and wait for its result
+
+    At most --plot_workers jobs are handed to the pool at a time, the others
+    wait their turn here. Until then, a job named by the browser request it
+    serves can be cancelled with `cancel_plot_job`, in which case
+    CancelledError is raised. If a process of the pool died (e.g. killed for
+    lack of memory), the pool is replaced and the job is tried once more.
+    """
+    global plot_running
+    waiting = concurrent.futures.Future()  # stands for the job until it runs
+    with PLOT_SLOTS:
+        if job is not None:
+            PLOT_JOBS[job] = (memo_id, waiting)
+        while plot_running >= args.plot_workers and not waiting.cancelled():
+            PLOT_SLOTS.wait()
+        if job is not None and PLOT_JOBS.get(job, (None, None))[1] is waiting:
+            del PLOT_JOBS[job]
+        if not waiting.set_running_or_notify_cancel():
+            raise concurrent.futures.CancelledError()
+        plot_running += 1
+    try:
+        return _run_in_plot_pool(func, *params)
+    finally:
+        with PLOT_SLOTS:
+            plot_running -= 1
+            PLOT_SLOTS.notify_all()
+
+
+def _run_in_plot_pool(func, *params):
+    pool = PLOT_POOL
+    for attempt in range(2):
+        try:
+            future = pool.submit(func, *params)
+        except concurrent.futures.process.BrokenProcessPool:
+            pool = replace_plot_pool(pool)
+            future = pool.submit(func, *params)
+        try:
+            return future.result()
+        except concurrent.futures.process.BrokenProcessPool:
+            if attempt > 0:
+                raise
+            pool = replace_plot_pool(pool)
+
+
+def cancel_plot_job(job):
+    """
+    Cancel a plot job that still waits for a process
+
+    Not if other requests wait for the same run, and not once it runs: the
+    pool then has it, and its processes cannot be interrupted.
+    """
+    with PLOT_SLOTS:
+        memo_id, future = PLOT_JOBS.get(job, (None, None))
+        if future is not None and WAITING.get(memo_id, 0) <= 1 and future.cancel():
+            PLOT_SLOTS.notify_all()
+            return True
+    return False
+
+
+def refresh_plot(memo_id, job=None):
+    """
+    Bring a rendered Plot up to date and push new points to its followers
+
+    CancelledError is passed on if `job` is cancelled, leaving the Plot as it
+    was, so that the caller does not take it for up to date.
+    """
+    pp = PLOTS.get(memo_id)
+    if pp is None:
+        return
+    with pp.lock:
+        new_points = pp.update_plots(job=job)
+    if len(new_points) > 0:
+        socketio.emit('metrics', {'memo_id': memo_id, 'lines': new_points}, room=memo_id)
+
+
+def render_file(id_, filename, job=None):
     ext = os.path.splitext(filename)[-1][1:].lower()
     path = os.path.join(MEMO_PATH, id_, filename)
-    if filename == 'results.pkl':
-        pp = Plot(id_)
-        script, div = components(pp.plots)
-        data = script + ''.join(div.values())
-    elif ext in ['png', 'jpg', 'jpeg', 'tif', 'tiff', 'bmp']:
-        with open(path, 'rb') as f:
-            data = base64.b64encode(f.read()).decode('ascii')
-        data = f'<img src="data:image/{ext};base64,{data}"/>'
+    if is_results_file(filename):
+        # a cached Plot only needs to process what was added since, and its
+        # html can be reused as is if no results were added at all
+        sig = results_signature(id_)
+        pp = get_plot(id_, sig, job)
+        with pp.lock:
+            if pp.rendered is None or pp.rendered[0] != sig:
+                script, div = components(pp.plots)
+                pp.rendered = (sig, script + ''.join(div.values()))
+            data = pp.rendered[1]
+        PLOTS.shrink()
+    elif os.path.isdir(path):
+        data = render_gallery(id_, filename)
+    elif ext in IMAGE_EXTS:
+        # served separately so that browsers can cache it
+        data = f'<img src="/memo/{id_}/{urllib.parse.quote(filename)}"/>'
     elif ext == 'html':
         # import ipdb; ipdb.set_trace()
         data = f'<iframe frameborder="0" width="600px" height="500px" src="/memo/{id_}/{filename}"></iframe>'
     else:
-        if ext == 'json':
-            data = json.load(open(path))
-            data = pprint.pformat(data)
+        if os.path.getsize(path) > VIEW_BYTES:
+            # the browser fetches the tail and earlier pages by range, which
+            # also goes for large json files, rather than pretty-printing them
+            src = f'/memo/{id_}/{urllib.parse.quote(filename)}'
+            return f"""
+        <figure>
+            <figcaption>{filename} <button class="tail-more">Earlier</button></figcaption>
+            <pre>
+                <code class="tail" id="select-this" data-src="{markupsafe.escape(src)}"></code>
+            </pre>
+        </figure>
+        """
+        elif ext == 'json':
+            with open(path) as f:
+                data = pprint.pformat(json.load(f))
         else:
-            if os.path.getsize(path) > 1024 ** 2:  # 1 MB
-                data = 'File too large'
-            else:
-                with open(path) as f:
-                    data = f.readlines()
-                data = ''.join(data)
+            with open(path) as f:
+                data = f.readlines()
+            data = ''.join(data)
 
         data = f"""
         <figure>
             <figcaption>{filename}</figcaption>
             <pre>
-                <code class="{ext}" id="select-this">{flask.escape(data)}</code>
+                <code class="{ext}" id="select-this">{markupsafe.escape(data)}</code>
             </pre>
         </figure>
         """
     return data
 
 
+def render_gallery(id_, folder):
+    """
+    Thumbnails of the images in a folder of a run, linking to the full images
+
+    Thumbnails are only requested by the browser as they scroll into view.
+    """
+    fnames = sorted(f for f in os.listdir(run_path(id_, folder))
+                    if os.path.splitext(f)[-1][1:].lower() in IMAGE_EXTS)
+    items = []
+    for fname in fnames:
+        url = urllib.parse.quote(f'{id_}/{folder}/{fname}')
+        name = markupsafe.escape(fname)
+        items.append(f'<a href="/memo/{url}" target="_blank" title="{name}">'
+                     f'<img loading="lazy" src="/thumbs/{url}" alt="{name}"/></a>')
+    return f"""
+        <figure>
+            <figcaption>{markupsafe.escape(folder)} ({len(fnames)} images)</figcaption>
+            <div class="gallery">{''.join(items)}</div>
+        </figure>
+        """
+
+
 class Handler(watchdog.events.FileSystemEventHandler):
+    """
+    Marks run folders that appear, move or disappear in MEMO_PATH as changed
+    """
 
     def on_created(self, event):
         if event.is_directory:
-            # idx = copy.copy(CURRENT_REC_MAX_IDX)
-            rec_id = os.path.basename(event.src_path)
-            data = _read_rec(rec_id)
-            if data is not None:
-                df = pandas.DataFrame([data])
-                df = df.set_index('id')
-                df = df[['script', 'script args', 'tag', 'description', 'outcome']]
-                df = format_table(df, return_rows=True)
-            # df = get_table(nrecs=NRECS)
-            # if idx is not None:
-            #     iloc = df.index.get_loc(idx)
-            # else:
-            #     iloc = -1
-            # df = format_table(df[:iloc], return_rows=True)
-                socketio.emit('folder updated', [df, rec_id])
+            UPDATES.touch(os.path.basename(event.src_path))
+
+    def on_deleted(self, event):
+        if event.is_directory:
+            UPDATES.touch(os.path.basename(event.src_path))
+
+    def on_moved(self, event):
+        if event.is_directory:
+            UPDATES.touch(os.path.basename(event.src_path))
+            if os.path.dirname(event.dest_path) == os.path.normpath(MEMO_PATH):
+                UPDATES.touch(os.path.basename(event.dest_path))
+
+
+def is_finished(rec):
+    # older runs recorded their end as 'end_time'
+    return rec.get('end time') is not None or 'end_time' in rec
+
+
+LOST_JOBS = {}  # memo_id -> meta.json mtime when the scheduler no longer had its job
+
+
+def job_state(folder, rec, mtime):
+    """
+    Get the job state of a run, including jobs that ended without a trace
+
+    A job killed hard, e.g. for its time limit or lack of memory, or
+    cancelled before it started, never records its end. Such a run is
+    'lost' if its scheduler no longer has the job (see Updates.poll_jobs) or
+    if it is running but did not refresh its meta.json for JOB_STALE, until
+    its meta.json changes again.
+    """
+    state = rec.get('job state')
+    if state not in ('pending', 'running') or is_finished(rec):
+        return state
+    lost = LOST_JOBS.get(folder)
+    if lost == mtime:
+        return 'lost'
+    if lost is not None:  # meta.json changed since
+        LOST_JOBS.pop(folder, None)
+    if state == 'running' and time.time() - mtime > JOB_STALE:
+        return 'lost'
+    return state
+
+
+class Updates(object):
+    """
+    Coalesces changes of run folders into batched table updates
+
+    Folders are only marked as changed when events come in; a background
+    thread reindexes each of them once it has been quiet for EVENT_DELAY
+    and sends all updated rows, and removed ids, to the browsers at once. A
+    new folder is retried until its meta.json can be read (e.g. when rsync
+    creates the folder first) for up to META_TIMEOUT. The meta.json of
+    unfinished runs is checked every ACTIVE_POLL, so that their end time
+    or edited fields show up without watching every run folder, and so that
+    running jobs that stopped refreshing it are marked as lost. Schedulers
+    are asked about the jobs of unfinished runs every JOB_POLL.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.changed = {}  # memo_id -> (time of the last event, time of the first)
+        self.active = {}  # memo_id -> meta.json mtime of unfinished runs
+        self.running = set()  # unfinished runs with a running job
+        for folder, mtime, rec in INDEX.recent(time.time() - ACTIVE_MAX_AGE):
+            if not is_finished(rec):
+                self.active[folder] = mtime
+                if rec.get('job state') == 'running':
+                    self.running.add(folder)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.poller = threading.Thread(target=self.poll_jobs, daemon=True)
+        self.poller.start()
+
+    def touch(self, memo_id):
+        now = time.time()
+        with self.lock:
+            first = self.changed.get(memo_id, (now, now))[1]
+            self.changed[memo_id] = (now, first)
+        self.wake.set()
+
+    def run(self):
+        last_poll = time.time()
+        while True:
+            self.wake.wait(EVENT_DELAY)
+            self.wake.clear()
+            now = time.time()
+            if now - last_poll >= ACTIVE_POLL:
+                last_poll = now
+                for memo_id, mtime in list(self.active.items()):
+                    if _meta_mtime(memo_id) != mtime:
+                        self.touch(memo_id)
+                    elif memo_id in self.running and now - mtime > JOB_STALE:
+                        self.touch(memo_id)  # to be marked as lost
+            with self.lock:
+                due = [m for m, (last, first) in self.changed.items()
+                       if now - last >= EVENT_DELAY]
+            if due:
+                try:
+                    self.process(due, now)
+                except Exception as err:  # keep the thread alive
+                    print(f'Could not update runs ({err})')
+
+    def poll_jobs(self):
+        while True:
+            time.sleep(JOB_POLL)
+            try:
+                self.check_jobs()
+            except Exception as err:  # keep the thread alive
+                print(f'Could not check job states ({err})')
+
+    def check_jobs(self):
+        """
+        Mark runs whose job their scheduler no longer has as lost
+
+        Only schedulers that can be reached are asked: those of clusters over
+        ssh, and the job queue of this machine for its own local runs.
+        """
+        host = memo.get_host_properties()[0]
+        jobs = collections.defaultdict(dict)  # (cluster, user, host) -> {job id: run}
+        for folder, mtime, rec in INDEX.recent(time.time() - ACTIVE_MAX_AGE):
+            cluster = memo.CLUSTERS.get(rec.get('cluster'))
+            if (cluster is None or rec.get('job id') is None or is_finished(rec) or
+                    rec.get('job state') not in ('pending', 'running')):
+                continue
+            if rec.get('remote host') == 'localhost' and rec.get('local host') != host:
+                continue  # run on another machine
+            key = (cluster, rec.get('user'), rec.get('remote host'))
+            jobs[key][str(rec['job id']).split('.')[0]] = (folder, mtime)
+        for (cluster, user, remote_host), runs in jobs.items():
+            states = cluster.job_states(user, remote_host)
+            if states is None:
+                continue
+            for job_id, (folder, mtime) in runs.items():
+                if job_id not in states:
+                    LOST_JOBS[folder] = mtime
+                    self.touch(folder)
+
+    def process(self, memo_ids, now):
+        rows = []
+        removed = []
+        for memo_id in memo_ids:
+            done = True
+            if not os.path.isdir(os.path.join(MEMO_PATH, memo_id)):
+                INDEX.remove(memo_id)
+                self.active.pop(memo_id, None)
+                removed.append(memo_id)
+                self.running.discard(memo_id)
+            else:
+                rec = INDEX.update(memo_id)
+                if rec is None:  # meta.json is not there or complete yet
+                    done = now - self.changed[memo_id][1] > META_TIMEOUT
+                else:
+                    rows.append(rec)
+                    if is_finished(rec):
+                        self.active.pop(memo_id, None)
+                    else:
+                        self.active[memo_id] = _meta_mtime(memo_id)
+                    if rec.get('job state') == 'running' and not is_finished(rec):
+                        self.running.add(memo_id)
+                    else:
+                        self.running.discard(memo_id)
+            with self.lock:
+                if done and self.changed[memo_id][0] <= now:
+                    del self.changed[memo_id]
+        if rows:
+            df = pandas.DataFrame(rows).reindex(columns=['id'] + TABLE_COLUMNS)
+            df = df.set_index('id').sort_index(ascending=False)
+            df['git commit'] = None
+            df['github url'] = None
+            socketio.emit('folder updated', table_rows(df))
+        if removed:
+            socketio.emit('folders removed', removed)
+
+
+def start():
+    """
+    Start the plot processes, the index and the threads watching runs
+
+    Called in the process that serves requests, which with gunicorn is its
+    worker rather than the process that imported this module.
+    """
+    global PLOT_POOL, INDEX, UPDATES, PLOTS, observer
+    # forked here, once everything the processes need is defined but before
+    # any other thread or the index connection exists
+    PLOT_POOL = make_plot_pool()
+    INDEX = Index()
+    INDEX.sync()
+    UPDATES = Updates()
+    PLOTS = PlotCache(args.plot_cache * 1024 ** 2)
+    observer = watchdog.observers.Observer()
+    observer.schedule(Handler(), MEMO_PATH, recursive=False)
+    observer.start()
+
+
+class RunHandler(watchdog.events.FileSystemEventHandler):
+    """
+    Pushes new metrics of a followed run when its results files change
+
+    Bursts of writes are coalesced into one update after LIVE_DELAY seconds.
+    """
+
+    def __init__(self, memo_id):
+        self.memo_id = memo_id
+        self.timer = None
+
+    def on_any_event(self, event):
+        path = getattr(event, 'dest_path', '') or event.src_path
+        if event.is_directory or not is_results_file(os.path.basename(path)):
+            return
+        if self.timer is None or not self.timer.is_alive():
+            self.timer = threading.Timer(LIVE_DELAY, refresh_plot, [self.memo_id])
+            self.timer.daemon = True
+            self.timer.start()
+
+
+@socketio.on('subscribe')
+def subscribe(memo_id):
+    flask_socketio.join_room(memo_id)
+    SUBSCRIBERS.setdefault(memo_id, set()).add(request.sid)
+    if memo_id not in LIVE_WATCHES:
+        LIVE_WATCHES[memo_id] = observer.schedule(
+            RunHandler(memo_id), os.path.join(MEMO_PATH, memo_id), recursive=False)
+
+
+@socketio.on('unsubscribe')
+def unsubscribe(memo_id):
+    flask_socketio.leave_room(memo_id)
+    _unsubscribe(memo_id, request.sid)
+
+
+@socketio.on('disconnect')
+def disconnect():
+    for memo_id in list(SUBSCRIBERS):
+        _unsubscribe(memo_id, request.sid)
+
+
+def _unsubscribe(memo_id, sid):
+    sids = SUBSCRIBERS.get(memo_id, set())
+    sids.discard(sid)
+    if len(sids) == 0:  # nobody follows this run anymore
+        SUBSCRIBERS.pop(memo_id, None)
+        watch = LIVE_WATCHES.pop(memo_id, None)
+        if watch is not None:
+            observer.unschedule(watch)
 
 
 # @socketio.on('connect')
 # def socket_connect():
-event_handler = Handler()
-observer = watchdog.observers.Observer()
-observer.schedule(event_handler, os.environ['MEMO'], recursive=False)
 
-observer.start()
+
+if gunicorn is not None:
+    class Server(gunicorn.app.base.BaseApplication):
+        """
+        Serves the app with gunicorn: one worker process, one thread per connection
+
+        A single worker, as runs, plots and Socket.IO rooms are kept in memory.
+        """
+
+        def load_config(self):
+            self.cfg.set('bind', f'0.0.0.0:{args.port}')
+            self.cfg.set('workers', 1)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('threads', SERVER_THREADS)
+
+        def load(self):
+            start()
+            return app
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=args.port, debug=True)
+    if gunicorn is None or args.debug:
+        # Werkzeug's development server, which Flask-SocketIO 5.3 and later
+        # only runs from a terminal
+        start()
+        socketio.run(app, host='0.0.0.0', port=args.port,
+                     debug=args.debug, use_reloader=args.debug)
+    else:
+        Server().run()